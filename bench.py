@@ -0,0 +1,548 @@
+#!/bin/python3
+# compiles every program in cases/ and runs it on clacvm, so compiler changes can be
+# judged by what the generated code costs to run
+import argparse
+import ast
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+
+import clacvm
+import new
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CASES = os.path.join(ROOT, "cases")
+COMPILER = os.path.join(ROOT, "new.py")
+DEFAULT_BASELINE = os.path.join(ROOT, "bench_baseline.json")
+
+# what to run once a case is loaded, for cases that do not call anything at the top level
+ENTRY_POINTS = {
+    "bug": "main",
+    "ex0": "5 double 0 double main",
+    "fib": "1 0 fib",
+    "for_loop": "100 loop",
+    "shake_entry": "main",
+    "sqrt": "17 sqrt 1000000 sqrt",
+    "ternary": "5 test 50 test",
+}
+
+# stops a miscompiled program that never terminates
+FUEL = 50_000_000
+
+# how deep --stress nests its programs by default
+STRESS_DEPTH = 10_000
+
+# these do not depend on the machine, so any increase is a regression
+EXACT_METRICS = ["instructions", "calls", "peak_stack", "tokens"]
+# these depend on the machine, so they are only saved with --timings, for a baseline that
+# stays on the machine that made it
+TIME_METRICS = ["compile_time", "run_time"]
+# wall time is noisy, it only counts as a regression past this factor of the baseline...
+TIME_TOLERANCE = 1.5
+# ...and only for cases that take long enough to measure
+TIME_FLOOR = 0.02
+
+
+@dataclass
+class Result:
+    entry: str | None
+    # set when the case did not compile or crashed while running
+    error: str | None = None
+
+    tokens: int | None = None
+    instructions: int | None = None
+    calls: int | None = None
+    peak_stack: int | None = None
+    output: list[int] = field(default_factory=list)
+    stack: list[int] = field(default_factory=list)
+
+    compile_time: float | None = None
+    run_time: float | None = None
+
+
+@dataclass
+class Expected:
+    """What a case declares about itself, in comment lines like `# output: 1 2 3`"""
+
+    # what it prints, checked whenever it runs
+    output: list[int] | None = None
+    # compiler flags it needs, after --compiler-args
+    args: list[str] = field(default_factory=list)
+    # part of the error it has to fail to compile with
+    error: str | None = None
+    # how many frames it may take at most, for cases that must run in constant depth
+    frames: int | None = None
+
+
+def expected(source: str) -> Expected:
+    declared = Expected()
+    for key, value in re.findall(
+        r"^# (output|args|error|frames): (.*)$", source, re.MULTILINE
+    ):
+        match key:
+            case "output":
+                declared.output = [int(token) for token in value.split()]
+            case "args":
+                declared.args = shlex.split(value)
+            case "error":
+                declared.error = value.strip()
+            case "frames":
+                declared.frames = int(value)
+    return declared
+
+
+def entry_point(name: str, source: str) -> str | None:
+    if name in ENTRY_POINTS:
+        return ENTRY_POINTS[name]
+
+    # top level calls with constant arguments, like run() or loop(0)
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    tokens: list[str] = []
+    for stmt in tree.body:
+        match stmt:
+            case ast.Expr(value=ast.Call(func=ast.Name(id=func), args=args)) if all(
+                isinstance(arg, ast.Constant) and isinstance(arg.value, int)
+                for arg in args
+            ):
+                tokens += [str(arg.value) for arg in args] + [func]
+    return " ".join(tokens) or None
+
+
+def error_message(text: str) -> str:
+    # reprs of python objects carry their address, which changes from run to run
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", text)
+
+
+def compile_case(path: str, compiler_args: list[str]) -> tuple[str | None, str, float]:
+    """Returns the compiled program (None on failure), the compiler's stderr and the time it took"""
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        # new.py writes out.clac into its working directory
+        process = subprocess.run(
+            [sys.executable, COMPILER, path, *compiler_args],
+            cwd=workdir,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            return None, process.stderr, elapsed
+        with open(os.path.join(workdir, "out.clac"), "r") as f:
+            return f.read(), process.stderr, elapsed
+
+
+def run_case(path: str, compiler_args: list[str], repeat: int) -> Result:
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, "r") as f:
+        source = f.read()
+    declared = expected(source)
+    result = Result(entry_point(name, source))
+
+    program, stderr, result.compile_time = compile_case(
+        path, compiler_args + declared.args
+    )
+    if program is None:
+        lines = stderr.strip().splitlines()
+        message = error_message(lines[-1] if lines else "failed")
+        # failing the way the case says it should is what it is there for
+        if declared.error is None or declared.error not in message:
+            result.error = "compile: " + message
+        return result
+    if declared.error is not None:
+        result.error = f"compile: succeeded, expected an error with {declared.error!r}"
+        return result
+    result.tokens = len(program.split())
+
+    if result.entry is None:
+        if declared.output is not None:
+            result.error = "run: nothing to run, see ENTRY_POINTS"
+        return result
+
+    # every run does the same work, the fastest one is the least disturbed by everything else
+    times: list[float] = []
+    for _ in range(repeat):
+        machine = clacvm.Machine(fuel=FUEL)
+        start = time.perf_counter()
+        try:
+            machine.load(program)
+            machine.run(result.entry)
+        except clacvm.ClacError as e:
+            result.error = f"run: {error_message(str(e))}"
+            break
+        finally:
+            times.append(time.perf_counter() - start)
+    result.run_time = min(times)
+
+    result.instructions = machine.instructions
+    result.calls = machine.calls
+    result.peak_stack = machine.peak_stack
+    result.output = machine.output
+    result.stack = machine.stack
+    if result.error is None and declared.output not in (None, machine.output):
+        result.error = f"run: printed {machine.output}, expected {declared.output}"
+    if (
+        result.error is None
+        and declared.frames is not None
+        and machine.peak_frames > declared.frames
+    ):
+        result.error = f"run: took {machine.peak_frames} frames, expected at most {declared.frames}"
+    return result
+
+
+def run_all(
+    compiler_args: list[str], only: list[str], repeat: int
+) -> dict[str, Result]:
+    results: dict[str, Result] = {}
+    for file in sorted(os.listdir(CASES)):
+        name, ext = os.path.splitext(file)
+        if ext != ".py" or (only and name not in only):
+            continue
+        results[name] = run_case(os.path.join(CASES, file), compiler_args, repeat)
+    return results
+
+
+def show(value: int | float | None) -> str:
+    match value:
+        case None:
+            return "-"
+        case float():
+            return f"{value * 1000:.1f}ms"
+        case _:
+            return str(value)
+
+
+def report(results: dict[str, Result]):
+    columns = [
+        "instructions",
+        "calls",
+        "peak_stack",
+        "tokens",
+        "compile_time",
+        "run_time",
+    ]
+    print(f"{'case':<16}" + "".join(f"{column:>14}" for column in columns))
+    for name, result in results.items():
+        row = "".join(f"{show(getattr(result, column)):>14}" for column in columns)
+        print(f"{name:<16}{row}" + (f"  ({result.error})" if result.error else ""))
+
+
+def compare(baseline: dict[str, Result], results: dict[str, Result]) -> list[str]:
+    """Prints how every case moved against the baseline, returns the regressions"""
+    regressions: list[str] = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name}: new case")
+            continue
+        before = baseline[name]
+
+        if (before.error is None) != (result.error is None):
+            message = f"{name}: {before.error or 'ok'} -> {result.error or 'ok'}"
+            print(message)
+            if result.error:
+                regressions.append(message)
+            continue
+        if result.error:
+            changed = "" if before.error == result.error else f", now {result.error}"
+            print(f"{name}: still failing{changed}")
+            continue
+        if (before.output, before.stack) != (result.output, result.stack):
+            message = f"{name}: output changed"
+            print(message)
+            regressions.append(message)
+
+        changes: list[str] = []
+        for metric in EXACT_METRICS:
+            old, new = getattr(before, metric), getattr(result, metric)
+            if old is None or new is None or old == new:
+                continue
+            change = f"{metric} {old} -> {new} ({(new - old) / max(old, 1):+.1%})"
+            changes.append(change)
+            if new > old:
+                regressions.append(f"{name}: {change}")
+
+        # a baseline saved without --timings has no wall times to compare
+        old_time, new_time = before.run_time, result.run_time
+        if (
+            old_time is not None
+            and new_time is not None
+            and max(old_time, new_time) >= TIME_FLOOR
+        ):
+            change = f"run_time {show(old_time)} -> {show(new_time)}"
+            if new_time > old_time * TIME_TOLERANCE:
+                changes.append(change)
+                regressions.append(f"{name}: {change}")
+            elif new_time * TIME_TOLERANCE < old_time:
+                changes.append(change)
+
+        print(f"{name}: " + (", ".join(changes) if changes else "unchanged"))
+
+    return regressions
+
+
+# --stress builds its programs straight as ASTs: python's parser gives up on blocks nested
+# a few thousand deep, and the point is that the compiler does not
+def name(id: str) -> ast.Name:
+    return ast.Name(id=id, ctx=ast.Load())
+
+
+def const(value: int) -> ast.Constant:
+    return ast.Constant(value=value)
+
+
+def less(left: ast.expr, right: ast.expr) -> ast.Compare:
+    return ast.Compare(left=left, ops=[ast.Lt()], comparators=[right])
+
+
+def emit(value: ast.expr) -> ast.Expr:
+    return ast.Expr(value=ast.Call(func=name("print"), args=[value], keywords=[]))
+
+
+def function(name: str, body: list[ast.stmt], returns: str | None) -> ast.FunctionDef:
+    return ast.FunctionDef(
+        name=name,
+        args=ast.arguments(args=[ast.arg(arg="x", annotation=ast.Name(id="int"))]),
+        body=body,
+        returns=const(None) if returns is None else ast.Name(id=returns),
+    )
+
+
+def module(func: ast.FunctionDef) -> ast.Module:
+    tree = ast.Module(body=[func], type_ignores=[])
+    # ast.fix_missing_locations recurses, and every node here can share a position anyway
+    for node in ast.walk(tree):
+        if "lineno" in node._attributes:
+            node.lineno = node.end_lineno = 1
+            node.col_offset = node.end_col_offset = 0
+    return tree
+
+
+def stress_elif(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # if x < 0: return 0 / elif x < 1: return 1 / ... / else: return depth
+    orelse: list[ast.stmt] = [ast.Return(value=const(depth))]
+    for k in reversed(range(depth)):
+        body: list[ast.stmt] = [ast.Return(value=const(k))]
+        orelse = [ast.If(test=less(name("x"), const(k)), body=body, orelse=orelse)]
+
+    xs = [-5, 0, depth // 2, depth - 1, depth + 3]
+    expected = [next((k for k in range(depth) if x < k), depth) for x in xs]
+    entry = " ".join(f"{x} classify print" for x in xs)
+    return module(function("classify", orelse, "int")), entry, expected
+
+
+def stress_nested_if(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # every level runs the next one inside its if and prints after it, so no arm returns
+    body: list[ast.stmt] = [emit(const(depth))]
+    for k in reversed(range(depth)):
+        level = ast.If(
+            test=less(const(k), name("x")), body=body, orelse=[emit(const(-k))]
+        )
+        body = [level, emit(const(k))]
+
+    x = depth // 3
+    expected = [-x] + list(range(x, -1, -1))
+    return module(function("count", body, None)), f"{x} count", expected
+
+
+def stress_expression(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # x + 1 + 2 + ... + depth
+    value: ast.expr = name("x")
+    for k in range(1, depth + 1):
+        value = ast.BinOp(left=value, op=ast.Add(), right=const(k))
+
+    expected = [clacvm.wrap(7 + depth * (depth + 1) // 2)]
+    body: list[ast.stmt] = [ast.Return(value=value)]
+    return module(function("total", body, "int")), "7 total print", expected
+
+
+def stress_deep_stack(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # 1 + (2 + (... + (depth + x))), which keeps every operand on the stack at once
+    value: ast.expr = name("x")
+    for k in reversed(range(1, depth + 1)):
+        value = ast.BinOp(left=const(k), op=ast.Add(), right=value)
+
+    expected = [clacvm.wrap(7 + depth * (depth + 1) // 2)]
+    body: list[ast.stmt] = [ast.Return(value=value)]
+    return module(function("total", body, "int")), "7 total print", expected
+
+
+def stress_statements(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # a = x / a = a * 3 + 1 / ... / a = a * 3 + depth / return a
+    store = ast.Name(id="a", ctx=ast.Store())
+    body: list[ast.stmt] = [ast.Assign(targets=[store], value=name("x"))]
+    expected = 7
+    for k in range(1, depth + 1):
+        times = ast.BinOp(left=name("a"), op=ast.Mult(), right=const(3))
+        value = ast.BinOp(left=times, op=ast.Add(), right=const(k))
+        body.append(ast.Assign(targets=[store], value=value))
+        expected = clacvm.wrap(expected * 3 + k)
+    body.append(ast.Return(value=name("a")))
+    return module(function("long", body, "int")), "7 long print", [expected]
+
+
+def stress_loop(depth: int) -> tuple[ast.Module, str, list[int]]:
+    # i = 0 / a = x / while i < depth: a = a * 3 + 1 / ... / i = i + 1 / print(a), with a body
+    # long enough to be called rather than inlined, which must still recurse in one frame
+    def store(id: str, value: ast.expr) -> ast.Assign:
+        return ast.Assign(targets=[ast.Name(id=id, ctx=ast.Store())], value=value)
+
+    body: list[ast.stmt] = []
+    for k in range(1, 9):
+        times = ast.BinOp(left=name("a"), op=ast.Mult(), right=const(3))
+        body.append(store("a", ast.BinOp(left=times, op=ast.Add(), right=const(k))))
+    body.append(store("i", ast.BinOp(left=name("i"), op=ast.Add(), right=const(1))))
+    loop = ast.While(test=less(name("i"), const(depth)), body=body, orelse=[])
+
+    expected = 7
+    for _ in range(depth):
+        for k in range(1, 9):
+            expected = clacvm.wrap(expected * 3 + k)
+    statements = [store("i", const(0)), store("a", name("x")), loop, emit(name("a"))]
+    return module(function("repeat", statements, None)), "7 repeat", [expected]
+
+
+STRESS_PROGRAMS = {
+    "elif": stress_elif,
+    "nested-if": stress_nested_if,
+    "expression": stress_expression,
+    "deep-stack": stress_deep_stack,
+    "statements": stress_statements,
+    "loop": stress_loop,
+}
+
+# how many frames the programs that run depth times may use, however big depth is
+STRESS_FRAMES = {"loop": 2}
+
+
+def stress(depth: int) -> bool:
+    """Compiles and runs every stress program nested depth deep, returns whether all of them worked"""
+    print(f"{'program':<16}{'depth':>8}{'compile_time':>14}{'tokens':>10}")
+    ok = True
+    for program, build in STRESS_PROGRAMS.items():
+        tree, entry, expected = build(depth)
+        start = time.perf_counter()
+        try:
+            compiled = new.compile_module(tree)
+            elapsed = time.perf_counter() - start
+            machine = clacvm.Machine(fuel=FUEL)
+            machine.load(compiled)
+            machine.run(entry)
+            error = None if machine.output == expected else "wrong output"
+            frames = STRESS_FRAMES.get(program, machine.peak_frames)
+            if error is None and machine.peak_frames > frames:
+                error = f"{machine.peak_frames} frames, expected at most {frames}"
+        except (RecursionError, MemoryError, clacvm.ClacError) as e:
+            # what a program nested too deep runs into, anything else is a bug to see whole
+            elapsed = time.perf_counter() - start
+            compiled = ""
+            error = f"{type(e).__name__}: {e}"
+
+        row = f"{program:<16}{depth:>8}{show(elapsed):>14}{len(compiled.split()):>10}"
+        print(row + (f"  ({error})" if error else ""))
+        ok = ok and error is None
+    return ok
+
+
+def load_baseline(path: str) -> dict[str, Result]:
+    with open(path, "r") as f:
+        data = json.load(f)
+    return {name: Result(**result) for name, result in data["cases"].items()}
+
+
+def save_baseline(
+    path: str, results: dict[str, Result], compiler_args: list[str], timings: bool
+):
+    cases = {name: asdict(result) for name, result in results.items()}
+    if not timings:
+        for result in cases.values():
+            for metric in TIME_METRICS:
+                del result[metric]
+    data = {"compiler_args": compiler_args, "cases": cases}
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the compiler on every program in cases/"
+    )
+    parser.add_argument(
+        "cases", nargs="*", help="only run these cases (by name, without .py)"
+    )
+    parser.add_argument(
+        "--compiler-args",
+        default="",
+        metavar="ARGS",
+        help='extra flags for new.py, e.g. --compiler-args="--no-schedule --no-peephole"',
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        metavar="N",
+        help="run every case N times and keep the fastest wall time",
+    )
+    parser.add_argument(
+        "--save",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        metavar="FILE",
+        help="write the results to a baseline file",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        metavar="FILE",
+        help="compare against a baseline file, exits with 1 on any regression",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="also save wall times with --save, which only compare on the same machine",
+    )
+    parser.add_argument(
+        "--stress",
+        nargs="?",
+        type=int,
+        const=STRESS_DEPTH,
+        metavar="DEPTH",
+        help=f"instead, compile and run generated programs nested DEPTH deep (default: {STRESS_DEPTH}), "
+        "exits with 1 if any of them fails",
+    )
+    cli = parser.parse_args()
+
+    if cli.stress is not None:
+        sys.exit(0 if stress(cli.stress) else 1)
+
+    compiler_args = shlex.split(cli.compiler_args)
+    results = run_all(compiler_args, cli.cases, cli.repeat)
+    report(results)
+
+    if cli.save:
+        save_baseline(cli.save, results, compiler_args, cli.timings)
+        print(f"saved baseline to {cli.save}")
+
+    if cli.compare:
+        print()
+        regressions = compare(load_baseline(cli.compare), results)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nno regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# calls to pure functions with constant arguments are evaluated while compiling, the same
+# calls with arguments only known at runtime must print the same
+# output: 1000 1000 49 49 243 243 5 3 5 3 -8 -8 2 2 7 7 7 7 2 4 0
+def prec() -> int:
+    return 1000
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def power(b: int, e: int) -> int:
+    if e < 1:
+        return 1
+    else:
+        return b * power(b, e - 1)
+
+
+def flip(p: tuple) -> tuple:
+    return (p[1], p[0])
+
+
+def neg(x: int) -> int:
+    return -x
+
+
+def ratio(a: int, b: int) -> int:
+    return a // b
+
+
+def clamp(x: int) -> int:
+    if x < 0:
+        return 0
+    else:
+        return x % 10
+
+
+def shout(x: int) -> int:
+    # prints, so every call to it has to run, constant arguments or not
+    print(x)
+    return x
+
+
+def shout_square(x: int) -> int:
+    return square(shout(x))
+
+
+def check(one: int, three: int, five: int, seven: int) -> None:
+    print(prec())
+    print(one * 1000)
+    print(square(7))
+    print(square(seven))
+    print(power(3, 5))
+    print(power(three, five))
+    p = flip((3, 5))
+    print(p[0])
+    print(p[1])
+    q = flip((three, five))
+    print(q[0])
+    print(q[1])
+    print(neg(8))
+    print(neg(seven + one))
+    print(ratio(14, 7))
+    print(ratio(14, seven))
+    if seven < 0:
+        # never runs, and evaluating it while compiling would divide by zero
+        print(ratio(7, 0))
+    else:
+        pass
+    print(clamp(17))
+    print(clamp(seven + 10))
+    print(shout(7))
+    y = shout_square(2)
+    print(y)
+    print(clamp(-3))
+
+
+def main() -> None:
+    check(1, 3, 5, 7)
+
+
+main()
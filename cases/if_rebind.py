@@ -0,0 +1,45 @@
+# ifs whose arms rebind (or first bind) variables that are read after them
+# output: 2 3 13 40 7 0
+def rebind(a: int) -> int:
+    x = 1
+    if a < 5:
+        x = 2
+    else:
+        x = 3
+    return x
+
+
+def nested(a: int, b: int) -> int:
+    x = 1
+    y = 10
+    if a < 5:
+        if b < 5:
+            x = 2
+        else:
+            x = 3
+        y = y + x
+    else:
+        y = 40
+    print(y)
+    return x
+
+
+def early(a: int) -> int:
+    x = 4
+    if a < 0:
+        return 0
+    else:
+        x = a + 3
+    return x
+
+
+def main() -> None:
+    print(rebind(1))
+    print(rebind(9))
+    nested(1, 9)
+    nested(9, 9)
+    print(early(4))
+    print(early(-1))
+
+
+main()
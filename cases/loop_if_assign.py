@@ -0,0 +1,35 @@
+# loops whose body assigns what it carries inside the arms of an if
+# output: -1 5 7 36 -491
+def steps(n: int) -> int:
+    i = 0
+    s = 0
+    while i < n:
+        if i < 3:
+            s = s + 2
+        else:
+            s = s - 1
+        i = i + 1
+    return s
+
+
+def zigzag(n: int) -> int:
+    t = 0
+    for k in range(n):
+        if k % 2 < 1:
+            t = t + k
+        else:
+            if k < 5:
+                t = t * 2
+            else:
+                print(k)
+        t = t + 1
+    return t
+
+
+def main() -> None:
+    print(steps(10))
+    print(zigzag(9))
+    print(steps(500))
+
+
+main()
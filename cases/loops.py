@@ -0,0 +1,82 @@
+# while and for loops are lowered to tail-recursive helpers, small range loops are unrolled
+# (fib carries three cells, too many for a tail call, so its 15 trips take a frame each,
+# every other loop runs in one)
+# frames: 20
+# output: 55 5050 0 10 20 30 4 8 12 30 14 899 -1 10 610 987 20 -1
+def total(n: int) -> int:
+    s = 0
+    i = 1
+    while i < n + 1:
+        s = s + i
+        i = i + 1
+    return s
+
+
+def steps() -> None:
+    for k in range(0, 31, 10):
+        print(k)
+
+
+def last(n: int) -> int:
+    # the loop variable keeps its last value after the loop
+    k = -1
+    for k in range(n):
+        pass
+    return k
+
+
+def pairs(n: int) -> int:
+    # nested loops, the inner one bound by the outer
+    c = 0
+    for i in range(n):
+        for j in range(i):
+            c = c + 1
+    return c
+
+
+def triangle(n: int) -> int:
+    t = 0
+    for i in range(n):
+        t += i
+    return t
+
+
+def find(n: int, x: int) -> int:
+    # returns from inside the loop
+    i = 0
+    while i < n:
+        if x < i * i:
+            return i
+        else:
+            i = i + 1
+    return -1
+
+
+def fib(n: int) -> tuple:
+    # a tuple carried through every iteration
+    p = (0, 1)
+    for i in range(n):
+        p = (p[1], p[0] + p[1])
+    return p
+
+
+def main() -> None:
+    print(total(10))
+    print(total(100))
+    steps()
+    print(last(5))
+    print(last(10) - 1)
+    print(pairs(5) + 2)
+    print(triangle(10) - 15)
+    print(find(20, 190))
+    print(find(900, 898 * 899))
+    print(find(3, 100))
+    print(triangle(5))
+    p = fib(15)
+    print(p[0])
+    print(p[1])
+    print(last(21) - 0)
+    print(last(0))
+
+
+main()
@@ -0,0 +1,28 @@
+# range bounds held in names that are rebound after their first assignment, so they are not
+# the constant they were first assigned and loops over them cannot be unrolled that many times
+# output: 5 0 1 2 3 30
+def augmented(a: int) -> int:
+    n = 3
+    n += 2
+    t = 0
+    for i in range(n):
+        t = t + a
+    return t
+
+
+def loop_variable(a: int) -> int:
+    k = 1
+    for k in range(a):
+        print(k)
+    t = 0
+    for i in range(k):
+        t = t + 10
+    return t
+
+
+def main() -> None:
+    print(augmented(1))
+    print(loop_variable(4))
+
+
+main()
@@ -0,0 +1,22 @@
+# an arm of an if that returns on both paths, with an if inside it that does not: the inner if
+# must only clean up after its own arms, not the frame of the function it is in
+# output: 1 2 6 2 2
+def choose(c: int, e: int) -> int:
+    d = (c, e)
+    if c < e:
+        if e < 10:
+            print(1)
+        else:
+            print(2)
+        return d[0] + c
+    else:
+        return d[1] + e
+
+
+def main() -> None:
+    print(choose(1, 5))
+    print(choose(7, 3))
+    print(choose(1, 50))
+
+
+main()
@@ -0,0 +1,14 @@
+# shaking from an entry point named on the command line keeps what it reaches
+# args: --shake --entry main
+# output: 3 12
+def unused(a: int) -> int:
+    return a + 1
+
+
+def double(a: int) -> int:
+    return a * 2
+
+
+def main() -> None:
+    print(3)
+    print(double(6))
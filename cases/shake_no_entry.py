@@ -0,0 +1,9 @@
+# nothing is called at module level, so there is nothing to shake from
+# args: --shake
+# error: nothing to shake from
+def unused(a: int) -> int:
+    return a + 1
+
+
+def main() -> None:
+    print(unused(1))
@@ -0,0 +1,44 @@
+# self-recursion through returning ifs is a tail call when it carries at most two cells, so
+# these run hundreds of iterations in a handful of frames
+# frames: 4
+# output: 405450 900 -900 4 1 0
+def total(n: int, acc: int) -> int:
+    if n < 1:
+        return acc
+    else:
+        return total(n - 1, acc + n)
+
+
+def walk(p: tuple) -> tuple:
+    if p[0] < 900:
+        return walk((p[0] + 1, p[1] - 1))
+    else:
+        return p
+
+
+def mix(n: int, acc: int) -> int:
+    # an arm too long to inline, called from the if rather than laid out in place
+    if 0 < n:
+        return mix(n - 1, (acc * 3 + n * 7 + 11) % 1000 - (acc * 5 + n) % 7 + n % 3 - 4)
+    else:
+        return acc % 21
+
+
+def count(n: int) -> None:
+    if n < 2:
+        print(n)
+    else:
+        count(n - 1)
+
+
+def main() -> None:
+    print(total(900, 0))
+    p = walk((0, 0))
+    print(p[0])
+    print(p[1])
+    print(mix(900, 0))
+    count(900)
+    print(total(0, 0))
+
+
+main()
@@ -0,0 +1,29 @@
+# unary minus on values only known at runtime, and in range bounds
+# output: -4 -4 7 1 0 -1 -2 -1 0 1 2 3 -6
+def neg(a: int) -> int:
+    return -a
+
+
+def down(a: int) -> None:
+    for i in range(1, -2, -1):
+        print(i + a)
+
+
+def up(b: int) -> int:
+    t = 0
+    for i in range(-2, b):
+        print(i)
+        t = t + i
+    return -(t + 3)
+
+
+def main() -> None:
+    s = 4
+    print(neg(4))
+    print(neg(s))
+    print(neg(-7))
+    down(0)
+    print(up(4))
+
+
+main()
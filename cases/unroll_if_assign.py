@@ -0,0 +1,46 @@
+# short range loops are unrolled, and ifs in the copies assign what the loop carries
+# output: 2 1 0 1 3 6 0 10 9 8 8 -2 -18
+def last_below(p0: int) -> int:
+    p1 = 9
+    for i1 in range(3):
+        if i1 < p0:
+            p1 = i1
+        else:
+            print(i1)
+    return p1
+
+
+def running(a: int) -> int:
+    t = 0
+    for i in range(4):
+        if i < a:
+            t = t + i
+        else:
+            if t < 5:
+                t = t + 10
+            else:
+                t = t - 1
+        print(t)
+    return t
+
+
+def pair(a: int) -> int:
+    lo = 0
+    hi = 0
+    for i in range(3):
+        if i < a:
+            lo = lo - 1
+        else:
+            hi = hi + 4
+    return lo * 10 + hi
+
+
+def main() -> None:
+    print(last_below(2))
+    running(5)
+    print(running(1))
+    print(pair(1))
+    print(pair(3) + pair(0))
+
+
+main()
@@ -0,0 +1,334 @@
+#!/bin/python3
+# profiles a program compiled by new.py while clacvm runs it, word by word
+#
+# every word call is a node in a tree of call paths (tail calls replace the node of their
+# caller, like they replace its frame, and recursive calls go back to the node of the
+# outermost call), and each instruction is counted against the node it ran in. words are
+# the sum of their nodes, and the paths are the collapsed stacks
+import argparse
+import io
+import sys
+from dataclasses import dataclass
+
+import clacvm
+import new
+from clacvm import (
+    ADD,
+    CALL,
+    DIV,
+    DROP,
+    IF,
+    LT,
+    MOD,
+    MUL,
+    NUM,
+    PICK,
+    POW,
+    PRINT,
+    ROT,
+    SKIP,
+    SUB,
+    SWAP,
+    UNDEFINED,
+    ClacError,
+    divide,
+    wrap,
+)
+
+# the node of whatever runs outside of any word
+TOP = "<top>"
+
+SORT_KEYS = ["exclusive", "inclusive", "calls", "peak_stack"]
+
+
+@dataclass
+class WordProfile:
+    name: str
+    # the python function and line the word was compiled from, if known
+    origin: tuple[str, int] | None = None
+    calls: int = 0
+    # instructions run by the word itself, and by it and everything it called
+    exclusive: int = 0
+    inclusive: int = 0
+    # deepest the stack got while the word (or anything it called) was running
+    peak_stack: int = 0
+
+    def label(self) -> str:
+        if self.origin is None:
+            return self.name
+        function, line = self.origin
+        return f"{self.name} ({function}:{line})"
+
+
+class ProfilingMachine(clacvm.Machine):
+    """clacvm.Machine, counting instructions per call path. execute is Machine.execute with the
+    counting added, kept apart so the plain machine stays as fast as it is"""
+
+    def __post_init__(self):
+        super().__post_init__()
+        # node 0 is TOP, every other node is a word called from its parent node
+        self.parents: list[int] = [0]
+        self.node_names: list[str] = [TOP]
+        self.children: dict[tuple[int, str], int] = {}
+        self.counts: list[int] = [0]
+        self.peaks: list[int] = [0]
+        self.calls_by_word: dict[str, int] = {}
+
+    def node(self, parent: int, name: str) -> int:
+        key = (parent, name)
+        if key in self.children:
+            return self.children[key]
+
+        # a path holds every word once at most, or recursion would make it as long as it is deep
+        ancestor = parent
+        while ancestor and self.node_names[ancestor] != name:
+            ancestor = self.parents[ancestor]
+        if ancestor:
+            self.children[key] = ancestor
+            return ancestor
+
+        self.children[key] = len(self.parents)
+        self.parents.append(parent)
+        self.node_names.append(name)
+        self.counts.append(0)
+        self.peaks.append(0)
+        return self.children[key]
+
+    def execute(self, ops: list[int], args: list):
+        stack = self.stack
+        output = self.output
+        frames: list[tuple[list[int], list, int, int]] = []
+        pc = 0
+        instructions = self.instructions
+        calls = self.calls
+        peak_stack = max(self.peak_stack, len(stack))
+        peak_frames = self.peak_frames
+        limit = -1 if self.fuel is None else self.fuel
+
+        names = {id(code[0]): name for name, code in self.words.items()}
+        counts = self.counts
+        peaks = self.peaks
+        current = 0
+
+        try:
+            while True:
+                if pc >= len(ops):
+                    if not frames:
+                        break
+                    ops, args, pc, current = frames.pop()
+                    continue
+
+                op = ops[pc]
+                pc += 1
+                instructions += 1
+                counts[current] += 1
+                if instructions == limit:
+                    raise ClacError(f"ran out of fuel after {limit} instructions")
+
+                if op == NUM:
+                    stack.append(args[pc - 1])
+                    if len(stack) > peak_stack:
+                        peak_stack = len(stack)
+                    if len(stack) > peaks[current]:
+                        peaks[current] = len(stack)
+                elif op == PICK:
+                    n = stack.pop()
+                    if n < 1 or n > len(stack):
+                        raise ClacError(f"cannot pick element {n}")
+                    stack.append(stack[-n])
+                    if len(stack) > peaks[current]:
+                        peaks[current] = len(stack)
+                elif op == CALL or op == UNDEFINED:
+                    callee = args[pc - 1]
+                    if op == UNDEFINED:
+                        if callee not in self.words:
+                            raise ClacError(f"undefined token {callee}")
+                        callee = self.words[callee]
+                    calls += 1
+                    name = names[id(callee[0])]
+                    self.calls_by_word[name] = self.calls_by_word.get(name, 0) + 1
+                    if pc < len(ops):
+                        frames.append((ops, args, pc, current))
+                        if len(frames) > peak_frames:
+                            peak_frames = len(frames)
+                        current = self.node(current, name)
+                    else:
+                        # a tail call takes the place of its caller (but never of TOP)
+                        current = self.node(
+                            self.parents[current] if current else 0, name
+                        )
+                    ops, args = callee
+                    pc = 0
+                elif op == DROP:
+                    stack.pop()
+                elif op == SWAP:
+                    stack[-1], stack[-2] = stack[-2], stack[-1]
+                elif op == ROT:
+                    stack.append(stack.pop(-3))
+                elif op == IF:
+                    if stack.pop() == 0:
+                        pc += 3
+                elif op == SKIP:
+                    n = stack.pop()
+                    if n < 0:
+                        raise ClacError(f"cannot skip {n} tokens")
+                    pc += n
+                elif op == PRINT:
+                    value = stack.pop()
+                    output.append(value)
+                    if self.echo:
+                        print(value)
+                else:
+                    y = stack.pop()
+                    x = stack.pop()
+                    if op == ADD:
+                        stack.append(wrap(x + y))
+                    elif op == SUB:
+                        stack.append(wrap(x - y))
+                    elif op == MUL:
+                        stack.append(wrap(x * y))
+                    elif op == LT:
+                        stack.append(1 if x < y else 0)
+                    elif op == DIV:
+                        stack.append(divide(x, y))
+                    elif op == MOD:
+                        stack.append(x - divide(x, y) * y)
+                    elif op == POW:
+                        if y < 0:
+                            raise ClacError("negative exponent")
+                        stack.append(wrap(pow(x, y, 1 << 32)))
+        except (ClacError, IndexError):
+            self.fault = (ops, pc - 1)
+            raise
+        finally:
+            self.instructions = instructions
+            self.calls = calls
+            self.peak_stack = peak_stack
+            self.peak_frames = peak_frames
+
+    def subtrees(self) -> tuple[list[int], list[int]]:
+        """Instructions run and deepest stack reached in every node and the nodes below it"""
+        totals = list(self.counts)
+        peaks = list(self.peaks)
+        # children always come after their parent
+        for node in reversed(range(1, len(self.parents))):
+            parent = self.parents[node]
+            totals[parent] += totals[node]
+            peaks[parent] = max(peaks[parent], peaks[node])
+        return totals, peaks
+
+    def words_profile(
+        self, origins: dict[str, tuple[str, int]] | None = None
+    ) -> list[WordProfile]:
+        origins = origins or {}
+        totals, peaks = self.subtrees()
+        words: dict[str, WordProfile] = {}
+
+        def word(name: str) -> WordProfile:
+            if name not in words:
+                words[name] = WordProfile(name, origins.get(name))
+            return words[name]
+
+        # no path holds a word twice, so nothing is counted twice in its inclusive total
+        for node, name in enumerate(self.node_names):
+            profile = word(name)
+            profile.exclusive += self.counts[node]
+            profile.inclusive += totals[node]
+            profile.peak_stack = max(profile.peak_stack, peaks[node])
+        for name, calls in self.calls_by_word.items():
+            word(name).calls = calls
+        return list(words.values())
+
+    def collapsed(self, origins: dict[str, tuple[str, int]] | None = None) -> list[str]:
+        """One line per call path that ran any instructions itself, as flamegraph.pl reads them"""
+        origins = origins or {}
+        labels = [
+            WordProfile(name, origins.get(name)).label() for name in self.node_names
+        ]
+        paths: list[str] = [labels[0]]
+        for node in range(1, len(self.parents)):
+            paths.append(f"{paths[self.parents[node]]};{labels[node]}")
+        return [f"{path} {count}" for path, count in zip(paths, self.counts) if count]
+
+
+def table(words: list[WordProfile], total: int) -> str:
+    rows = [("word", "calls", "exclusive", "%", "inclusive", "%", "peak stack")]
+    for w in words:
+        rows.append(
+            (
+                w.label(),
+                str(w.calls),
+                str(w.exclusive),
+                f"{100 * w.exclusive / max(total, 1):.1f}",
+                str(w.inclusive),
+                f"{100 * w.inclusive / max(total, 1):.1f}",
+                str(w.peak_stack),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    )
+
+
+def compile_program(path: str) -> tuple[str, dict[str, tuple[str, int]]]:
+    """The clac program in path (compiling it first if it is python), and where its words came from"""
+    with open(path, "r") as f:
+        source = f.read()
+    if not path.endswith(".py"):
+        return source, {}
+
+    program = io.StringIO()
+    origins: dict[str, tuple[str, int]] = {}
+    new.write_source(source, program, origins=origins)
+    return program.getvalue(), origins
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs a Clac program on clacvm and reports where its instructions go"
+    )
+    parser.add_argument(
+        "file", help="python file to compile and profile, or an already compiled .clac"
+    )
+    parser.add_argument(
+        "words", nargs="*", help="tokens to run once the program is loaded"
+    )
+    parser.add_argument(
+        "--fuel", type=int, help="stop after running this many instructions"
+    )
+    parser.add_argument(
+        "--sort",
+        choices=SORT_KEYS,
+        default="exclusive",
+        help="column to sort the table by (default: exclusive)",
+    )
+    parser.add_argument(
+        "--collapsed",
+        metavar="PATH",
+        help="write collapsed stacks for flamegraph.pl or speedscope to PATH",
+    )
+    cli = parser.parse_args()
+
+    program, origins = compile_program(cli.file)
+    machine = ProfilingMachine(echo=True, fuel=cli.fuel)
+    try:
+        machine.load(program)
+        machine.run(" ".join(cli.words))
+    except ClacError as e:
+        print(f"error: {e}", file=sys.stderr)
+
+    words = machine.words_profile(origins)
+    words.sort(key=lambda w: getattr(w, cli.sort), reverse=True)
+    print(table(words, machine.instructions))
+    if cli.collapsed:
+        with open(cli.collapsed, "w") as f:
+            f.write("\n".join(machine.collapsed(origins)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/bin/python3
+# reference interpreter for the Clac programs written by new.py
+#
+# every definition is resolved up front into two parallel arrays (opcodes and their
+# arguments), calls point straight at the callee's arrays and `if`/`skip` jump by
+# token index, so running a token never looks anything up by name
+import argparse
+import json
+import sys
+from dataclasses import dataclass, field
+
+INT_MIN = -(2**31)
+
+# opcodes
+NUM = 0
+CALL = 1
+PRINT = 2
+DROP = 3
+SWAP = 4
+ROT = 5
+PICK = 6
+IF = 7
+SKIP = 8
+ADD = 9
+SUB = 10
+MUL = 11
+DIV = 12
+MOD = 13
+POW = 14
+LT = 15
+UNDEFINED = 16
+
+BUILTINS = {
+    "print": PRINT,
+    "drop": DROP,
+    "swap": SWAP,
+    "rot": ROT,
+    "pick": PICK,
+    "if": IF,
+    "skip": SKIP,
+    "+": ADD,
+    "-": SUB,
+    "*": MUL,
+    "/": DIV,
+    "%": MOD,
+    "**": POW,
+    "<": LT,
+}
+
+Code = tuple[list[int], list]
+
+
+class ClacError(Exception):
+    pass
+
+
+def wrap(value: int) -> int:
+    # clac integers are 32 bit two's complement and wrap around on overflow
+    value &= 0xFFFFFFFF
+    return value - (1 << 32) if value & 0x80000000 else value
+
+
+def is_number(token: str) -> bool:
+    return token.lstrip("-").isdigit() and token != "-"
+
+
+def divide(x: int, y: int) -> int:
+    # truncates towards zero, like C
+    if y == 0:
+        raise ClacError("division by zero")
+    if x == INT_MIN and y == -1:
+        raise ClacError("overflow in division")
+    quotient = abs(x) // abs(y)
+    return quotient if (x < 0) == (y < 0) else -quotient
+
+
+@dataclass
+class Machine:
+    stack: list[int] = field(default_factory=list)
+    output: list[int] = field(default_factory=list)
+    # echo printed values to stdout as they are printed
+    echo: bool = False
+    # give up after this many instructions, None runs forever
+    fuel: int | None = None
+
+    instructions: int = 0
+    calls: int = 0
+    peak_stack: int = 0
+    # deepest chain of callers that had to be remembered (tail calls do not count)
+    peak_frames: int = 0
+
+    def __post_init__(self):
+        self.words: dict[str, Code] = {}
+        # the opcodes and index of the instruction that raised the last error
+        self.fault: tuple[list[int], int] | None = None
+
+    def load(self, program: str):
+        """Reads the definitions in program, anything outside a definition is run in order"""
+        tokens = program.split()
+        pending: list[str] = []
+        i = 0
+        while i < len(tokens):
+            if tokens[i] != ":":
+                pending.append(tokens[i])
+                i += 1
+                continue
+            if i + 1 >= len(tokens):
+                raise ClacError("definition without a name")
+            try:
+                end = tokens.index(";", i + 2)
+            except ValueError:
+                raise ClacError(f"definition of {tokens[i + 1]} is missing ;") from None
+            self.define(tokens[i + 1], tokens[i + 2 : end])
+            i = end + 1
+
+        if pending:
+            self.run(" ".join(pending))
+
+    def define(self, name: str, body: list[str]):
+        # the arrays are filled in place, so callers that were resolved earlier see the new body
+        ops, args = self.words.setdefault(name, ([], []))
+        ops.clear()
+        args.clear()
+        for token in body:
+            op, arg = self.resolve(token)
+            ops.append(op)
+            args.append(arg)
+
+    def resolve(self, token: str) -> tuple[int, object]:
+        if is_number(token):
+            return NUM, wrap(int(token))
+        if token in BUILTINS:
+            return BUILTINS[token], None
+        if token in self.words:
+            return CALL, self.words[token]
+        # may still be defined later on, so look it up again when it runs
+        return UNDEFINED, token
+
+    def faulted_word(self) -> tuple[str, int] | None:
+        """The word and token index the last error was raised at, None outside of any word"""
+        if self.fault is None:
+            return None
+        ops, index = self.fault
+        for name, code in self.words.items():
+            if code[0] is ops:
+                return name, index
+        return None
+
+    def run(self, source: str) -> list[int]:
+        """Runs the tokens in source against the current stack, returns what they printed"""
+        printed_before = len(self.output)
+        ops, args = [], []
+        for token in source.split():
+            op, arg = self.resolve(token)
+            ops.append(op)
+            args.append(arg)
+
+        try:
+            self.execute(ops, args)
+        except IndexError:
+            raise ClacError("stack underflow") from None
+        return self.output[printed_before:]
+
+    def execute(self, ops: list[int], args: list):
+        stack = self.stack
+        output = self.output
+        frames: list[tuple[list[int], list, int]] = []
+        pc = 0
+        instructions = self.instructions
+        calls = self.calls
+        peak_stack = max(self.peak_stack, len(stack))
+        peak_frames = self.peak_frames
+        limit = -1 if self.fuel is None else self.fuel
+
+        try:
+            while True:
+                if pc >= len(ops):
+                    if not frames:
+                        break
+                    ops, args, pc = frames.pop()
+                    continue
+
+                op = ops[pc]
+                pc += 1
+                instructions += 1
+                if instructions == limit:
+                    raise ClacError(f"ran out of fuel after {limit} instructions")
+
+                if op == NUM:
+                    stack.append(args[pc - 1])
+                    if len(stack) > peak_stack:
+                        peak_stack = len(stack)
+                elif op == PICK:
+                    n = stack.pop()
+                    if n < 1 or n > len(stack):
+                        raise ClacError(f"cannot pick element {n}")
+                    stack.append(stack[-n])
+                elif op == CALL or op == UNDEFINED:
+                    callee = args[pc - 1]
+                    if op == UNDEFINED:
+                        if callee not in self.words:
+                            raise ClacError(f"undefined token {callee}")
+                        callee = self.words[callee]
+                    calls += 1
+                    # nothing is left to run after a call in tail position, so do not come back here
+                    if pc < len(ops):
+                        frames.append((ops, args, pc))
+                        if len(frames) > peak_frames:
+                            peak_frames = len(frames)
+                    ops, args = callee
+                    pc = 0
+                elif op == DROP:
+                    stack.pop()
+                elif op == SWAP:
+                    stack[-1], stack[-2] = stack[-2], stack[-1]
+                elif op == ROT:
+                    stack.append(stack.pop(-3))
+                elif op == IF:
+                    if stack.pop() == 0:
+                        pc += 3
+                elif op == SKIP:
+                    n = stack.pop()
+                    if n < 0:
+                        raise ClacError(f"cannot skip {n} tokens")
+                    pc += n
+                elif op == PRINT:
+                    value = stack.pop()
+                    output.append(value)
+                    if self.echo:
+                        print(value)
+                else:
+                    y = stack.pop()
+                    x = stack.pop()
+                    if op == ADD:
+                        stack.append(wrap(x + y))
+                    elif op == SUB:
+                        stack.append(wrap(x - y))
+                    elif op == MUL:
+                        stack.append(wrap(x * y))
+                    elif op == LT:
+                        stack.append(1 if x < y else 0)
+                    elif op == DIV:
+                        stack.append(divide(x, y))
+                    elif op == MOD:
+                        # takes the sign of the dividend, like C
+                        stack.append(x - divide(x, y) * y)
+                    elif op == POW:
+                        if y < 0:
+                            raise ClacError("negative exponent")
+                        stack.append(wrap(pow(x, y, 1 << 32)))
+        except (ClacError, IndexError):
+            self.fault = (ops, pc - 1)
+            raise
+        finally:
+            self.instructions = instructions
+            self.calls = calls
+            self.peak_stack = peak_stack
+            self.peak_frames = peak_frames
+
+
+def fault_location(machine: Machine, source_map: str | None) -> str:
+    if (faulted := machine.faulted_word()) is None:
+        return ""
+    word, index = faulted
+    location = f" in {word} at token {index}"
+    if source_map is not None:
+        with open(source_map, "r") as f:
+            mapped = json.load(f)
+        spans = mapped["words"].get(word)
+        if spans and spans[index] is not None:
+            line, column = spans[index]
+            location += f" ({mapped['source']}:{line}:{column})"
+    return location
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a Clac program")
+    parser.add_argument("file", help="clac program, usually out.clac")
+    parser.add_argument(
+        "words", nargs="*", help="tokens to run once the program is loaded"
+    )
+    parser.add_argument(
+        "--fuel", type=int, help="stop after running this many instructions"
+    )
+    parser.add_argument(
+        "--source-map",
+        metavar="PATH",
+        help="source map written by new.py, to tell which python line an error came from",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="report instructions, calls and peak stack depth on stderr",
+    )
+    cli = parser.parse_args()
+
+    machine = Machine(echo=True, fuel=cli.fuel)
+    with open(cli.file, "r") as f:
+        program = f.read()
+
+    try:
+        machine.load(program)
+        machine.run(" ".join(cli.words))
+    except ClacError as e:
+        print(f"error: {e}{fault_location(machine, cli.source_map)}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if cli.stats:
+            print(
+                f"stack: {machine.stack}\n"
+                f"instructions: {machine.instructions}\n"
+                f"calls: {machine.calls}\n"
+                f"peak stack: {machine.peak_stack}\n"
+                f"peak frames: {machine.peak_frames}",
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,38 @@
 #!/bin/python3
+import argparse
 import ast
+import contextlib
+import copy
+import dataclasses
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import pickle
 import sys
+import time
+import tracemalloc
+from array import array
+from collections import Counter
+from collections.abc import (
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    MutableMapping,
+    MutableSequence,
+)
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from abc import ABC, abstractmethod
+from typing import Any, TextIO
+
+# leveled tracing, silent unless it is turned up (main does with -v): info says what the
+# passes did, debug follows the code generator around
+log = logging.getLogger("cclac")
 
 # a b
 # a+b
@@ -42,14 +72,58 @@ class PyTuple:
     position: int
 
 
-class OpCode(ABC):
-    @abstractmethod
+# what a Code buffer stores for every instruction, next to its operand (if it has one)
+(
+    OP_PUSH,
+    OP_PICK,
+    OP_SWAP,
+    OP_ROT,
+    OP_DROP,
+    OP_IF,
+    OP_SKIP,
+    OP_BINOP,
+    OP_CALL,
+    OP_INLINE_IF,
+) = range(10)
+
+# by kind, None where it depends on the operand
+STACK_DELTA: tuple[int | None, ...] = (1, 0, 0, 0, -1, -1, -1, -1, None, None)
+MNEMONIC: tuple[str | None, ...] = (
+    *(None, "pick", "swap", "rot", "drop", "if", "skip"),
+    *(None, None, None),
+)
+
+
+class OpCode:
+    # the instruction classes are views of what a Code buffer holds, made for the passes to work on
+    __slots__ = ()
+    kind: int
+
     def stack_delta(self) -> int:
-        raise Exception()
+        return STACK_DELTA[self.kind]
 
-    @abstractmethod
     def assemble(self) -> str:
-        raise Exception()
+        return MNEMONIC[self.kind]
+
+    def operand(self):
+        # what a Code buffer stores for this instruction
+        return None
+
+    def tokens(self) -> list[str]:
+        return [self.assemble()]
+
+
+class SharedOpCode(OpCode):
+    # instructions without an operand are all alike, so every Swap() is the same object
+    __slots__ = ()
+
+    def __new__(cls):
+        if "instance" not in cls.__dict__:
+            cls.instance = super().__new__(cls)
+        return cls.instance
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
 
 
 @dataclass
@@ -58,80 +132,139 @@ class ClacFunc:
     arg_count: int
     ret_count: int
 
-    code: list[OpCode]
+    code: "Code"
     children: list  # list of clacfuncs
 
+    # reads values from below its own frame, so it must be called at the depth it was defined at
+    captures: bool = False
+    # fully compiled and frame relative, so code can be spliced into any caller
+    # (placeholders for functions still being compiled and builtins are not)
+    inlinable: bool = False
+    # only ever reads its own arguments, so callers may keep anything they like below them
+    own_frame: bool = False
+    # generated by the compiler rather than from a python function, defined once before
+    # the first function that calls it
+    shared: bool = False
+    # the python function this was compiled from and the line it starts at (for an arm, the
+    # line of its first statement), None for shared words
+    origin: tuple[str, int] | None = None
+
 
 ClacValue = ClacVoid | ClacInt | PyTuple | ClacFunc
 
+# marks a name that was deleted from a scope while its parent still binds it
+DELETED = object()
 
-@dataclass
-class If(OpCode):
-    def stack_delta(self):
-        return -1
 
-    def assemble(self) -> str:
-        return "if"
+class Scope(MutableMapping[str, ClacValue]):
+    """The names a compiler can see: its own bindings on top of the enclosing scope's.
+    Making a child is O(1), writes and deletes only ever touch the innermost scope"""
 
+    __slots__ = ("local", "parent")
 
-class Swap(OpCode):
-    def stack_delta(self):
-        return 0
+    def __init__(
+        self, parent: "Scope | None" = None, local: dict[str, ClacValue] | None = None
+    ):
+        self.local: dict = {} if local is None else local
+        self.parent = parent
 
-    def assemble(self):
-        return "swap"
+    def child(self) -> "Scope":
+        return Scope(self)
 
+    def lookup(self, name: str):
+        passed: list[Scope] = []
+        scope = self
+        while scope is not None:
+            if name in scope.local:
+                value = scope.local[name]
+                break
+            passed.append(scope)
+            scope = scope.parent
+        else:
+            return DELETED
 
-class Rot(OpCode):
-    def stack_delta(self):
-        return 0
+        # nothing above a compiler changes while it runs, so the next lookup from any scope
+        # on the way can stop there (arms nested deep inside each other often look a name up
+        # innermost first, before any of the arms around them did)
+        for scope in passed:
+            scope.local[name] = value
+        return value
 
-    def assemble(self):
-        return "rot"
+    def __getitem__(self, name: str) -> ClacValue:
+        value = self.lookup(name)
+        if value is DELETED:
+            raise KeyError(name)
+        return value
 
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and self.lookup(name) is not DELETED
 
-@dataclass
-class Pick(OpCode):
-    def stack_delta(self):
-        return 0
+    def __setitem__(self, name: str, value: ClacValue):
+        self.local[name] = value
 
-    def assemble(self):
-        return "pick"
+    def __delitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.local[name] = DELETED
 
+    def flatten(self) -> dict[str, ClacValue]:
+        chain = []
+        scope = self
+        while scope is not None:
+            chain.append(scope.local)
+            scope = scope.parent
+        merged = {}
+        for local in reversed(chain):
+            merged.update(local)
+        return {name: value for name, value in merged.items() if value is not DELETED}
 
-class Skip(OpCode):
-    def stack_delta(self):
-        return -1
+    def __iter__(self):
+        return iter(self.flatten())
 
-    def assemble(self):
-        return "skip"
+    def __len__(self) -> int:
+        return len(self.flatten())
 
 
-class Drop(OpCode):
-    def stack_delta(self):
-        return -1
+class If(SharedOpCode):
+    kind = OP_IF
 
-    def assemble(self):
-        return "drop"
 
+class Swap(SharedOpCode):
+    kind = OP_SWAP
 
-@dataclass
+
+class Rot(SharedOpCode):
+    kind = OP_ROT
+
+
+class Pick(SharedOpCode):
+    kind = OP_PICK
+
+
+class Skip(SharedOpCode):
+    kind = OP_SKIP
+
+
+class Drop(SharedOpCode):
+    kind = OP_DROP
+
+
+@dataclass(slots=True)
 class Push(OpCode):
     value: int
-
-    def stack_delta(self):
-        # match (self.value):
-        #     case int():
-        #         return 1
-        return 1
+    kind = OP_PUSH
 
     def assemble(self):
         return f"{self.value}"
 
+    def operand(self):
+        return self.value
 
-@dataclass
+
+@dataclass(slots=True)
 class Call(OpCode):
     func: ClacFunc
+    kind = OP_CALL
 
     def assemble(self):
         return f"{self.func.name}"
@@ -139,16 +272,411 @@ class Call(OpCode):
     def stack_delta(self) -> int:
         return self.func.ret_count - self.func.arg_count
 
+    def operand(self):
+        return self
 
-@dataclass
+
+@dataclass(slots=True)
 class BinOp(OpCode):
     operator: str
+    kind = OP_BINOP
+
+    def assemble(self):
+        return f"{self.operator}"
+
+    def operand(self):
+        return self.operator
+
+
+# placeholder token that sits in the last slot skipped by `if`, it is never executed
+IF_FILLER = "0"
+
+
+@dataclass
+class InlineIf(OpCode):
+    # consumes the test on top of the stack, then runs one of the arms in place
+    body: "Code"
+    orelse: "Code"
+    # lay the else arm out last, so a call at its end is the last token of the definition
+    else_last: bool = False
+    # the same for a body that is a single call, which would otherwise go first
+    body_last: bool = False
+    kind = OP_INLINE_IF
+
+    def __post_init__(self):
+        # worked out once, nested ifs would otherwise walk every arm below them again
+        # (passes rewrite the arms in place, but never change what they do to the stack)
+        self.delta = -1 + self.body.stack_delta()
 
     def stack_delta(self):
-        return -1
+        return self.delta
 
     def assemble(self):
-        return f"{self.operator}"
+        return " ".join(self.tokens())
+
+    def tokens(self) -> list[str]:
+        return list(code_tokens(Code([self])))
+
+    def operand(self):
+        return self
+
+    def layout(self, body: int, orelse: int) -> list["str | Code"]:
+        """The tokens around the arms, given how many tokens each arm assembles to"""
+        # `if` skips the next three tokens when the test is zero
+        if body == 1 and not self.body_last:
+            # test if <body> <len orelse> skip <orelse>
+            return ["if", self.body, f"{orelse}", "skip", self.orelse]
+
+        if self.else_last and body and orelse:
+            # test if 3 skip _ <len body + 2> skip <body> <len orelse> skip <orelse>
+            return ["if", "3", "skip", IF_FILLER, f"{body + 2}", "skip"] + (
+                [self.body, f"{orelse}", "skip", self.orelse]
+            )
+
+        # test if <n> skip _ <orelse> <len body> skip <body>
+        # where n jumps over the filler, the else arm and its skip to land on the body
+        jump = [f"{body}", "skip"] if body else []
+        return ["if", f"{1 + orelse + len(jump)}", "skip", IF_FILLER, self.orelse] + (
+            jump + [self.body]
+        )
+
+
+# shared by every view of an instruction without an operand
+SHARED_OPCODES = {op.kind: op for op in (If(), Swap(), Rot(), Pick(), Skip(), Drop())}
+
+
+def view(kind: int, operand) -> OpCode:
+    if kind == OP_PUSH:
+        return Push(operand)
+    if kind == OP_BINOP:
+        return BinOp(operand)
+    if operand is not None:
+        # calls and inline ifs are stored as their views
+        return operand
+    return SHARED_OPCODES[kind]
+
+
+# an instruction as a Code buffer stores it, (kind, operand)
+Entry = tuple[int, Any]
+
+
+class Code(MutableSequence[OpCode]):
+    """The instructions of a function or an if-arm: the kind of every instruction packed into a
+    byte array, and a parallel list of operands (the value of a push, the operator of a binop,
+    calls and inline ifs as themselves, None for the rest). Indexing hands out OpCode views,
+    passes that look at instructions one by one work on a list of those and write it back"""
+
+    __slots__ = ("kinds", "operands")
+
+    def __init__(self, ops: Iterable[OpCode] = ()):
+        self.kinds = array("B")
+        self.operands: list = []
+        for op in ops:
+            self.append(op)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __iter__(self) -> Iterator[OpCode]:
+        return map(view, self.kinds, self.operands)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(map(view, self.kinds[index], self.operands[index]))
+        return view(self.kinds[index], self.operands[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            ops = list(value)
+            self.kinds[index] = array("B", [op.kind for op in ops])
+            self.operands[index] = [op.operand() for op in ops]
+        else:
+            self.kinds[index] = value.kind
+            self.operands[index] = value.operand()
+
+    def __delitem__(self, index):
+        del self.kinds[index]
+        del self.operands[index]
+
+    def insert(self, index: int, op: OpCode):
+        self.kinds.insert(index, op.kind)
+        self.operands.insert(index, op.operand())
+
+    def append(self, op: OpCode):
+        self.kinds.append(op.kind)
+        self.operands.append(op.operand())
+
+    def entries(self) -> Iterator[Entry]:
+        return zip(self.kinds, self.operands)
+
+    def copy(self) -> "Code":
+        copied = type(self)()
+        copied.kinds = self.kinds[:]
+        copied.operands = self.operands[:]
+        return copied
+
+    def stack_delta(self) -> int:
+        delta = 0
+        for kind, operand in self.entries():
+            fixed = STACK_DELTA[kind]
+            delta += operand.stack_delta() if fixed is None else fixed
+        return delta
+
+    def __repr__(self):
+        return f"Code({list(self)!r})"
+
+
+# where in the source an instruction came from, as (line, column)
+Span = tuple[int, int]
+
+
+class MappedCode(Code):
+    """Code that also keeps the span of every instruction, for source maps. Only compiled when
+    they are asked for, so plain Code never pays for it. Instructions that survive a rewrite
+    keep their span, the ones a rewrite puts in take the spans of the ones it took out"""
+
+    __slots__ = ("spans",)
+
+    def __init__(self, ops: Iterable[OpCode] = ()):
+        self.spans: list[Span | None] = []
+        super().__init__(ops)
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            super().__setitem__(index, value)
+            return
+        ops = list(value)
+        before = list(zip(self.kinds[index], self.operands[index]))
+        after = [(op.kind, op.operand()) for op in ops]
+        spans = carry_spans(before, self.spans[index], after)
+        super().__setitem__(index, ops)
+        self.spans[index] = spans
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        del self.spans[index]
+
+    def insert(self, index: int, op: OpCode, span: Span | None = None):
+        super().insert(index, op)
+        self.spans.insert(index, span)
+
+    def append(self, op: OpCode, span: Span | None = None):
+        super().append(op)
+        self.spans.append(span)
+
+    def copy(self) -> "MappedCode":
+        copied = super().copy()
+        copied.spans = self.spans[:]
+        return copied
+
+
+# instructions that have to match again after an edit before the two sides are back in step
+SPAN_RESYNC = 4
+
+
+def carry_spans(
+    before: list[Entry], spans: list[Span | None], after: list[Entry]
+) -> list[Span | None]:
+    """The spans of after, when it replaces the instructions before (which had spans). Where
+    the two differ, they are back in step at the nearest point where the next SPAN_RESYNC
+    instructions match again (passes only rewrite a window at a time, so it is never further
+    than that), and the instructions after put in between take the spans of the ones it took out"""
+
+    def key(entry: Entry):
+        # calls and inline ifs are only the same instruction if they are the same object
+        kind, operand = entry
+        return (kind, operand if isinstance(operand, (int, str)) else id(operand))
+
+    old, new = list(map(key, before)), list(map(key, after))
+
+    def in_step(i: int, j: int) -> bool:
+        if i > len(old) or j > len(new):
+            return False
+        length = min(SPAN_RESYNC, len(old) - i, len(new) - j)
+        return old[i : i + length] == new[j : j + length] and (
+            length == SPAN_RESYNC
+            or (i + length == len(old)) == (j + length == len(new))
+        )
+
+    carried: list[Span | None] = []
+    i = j = 0
+    while j < len(new):
+        if i < len(old) and old[i] == new[j]:
+            carried.append(spans[i])
+            i, j = i + 1, j + 1
+            continue
+        # the smallest edit first, by how many instructions it takes out and puts in together
+        taken, put = next(
+            (
+                (taken, edit - taken)
+                for edit in range(1, 2 * SCHEDULE_WINDOW)
+                for taken in range(
+                    max(0, edit - SCHEDULE_WINDOW), min(edit, SCHEDULE_WINDOW) + 1
+                )
+                if in_step(i + taken, j + edit - taken)
+            ),
+            (len(old) - i, len(new) - j),
+        )
+        replaced = spans[i : i + taken] or spans[max(i - 1, 0) : i] or [None]
+        carried += [replaced[min(k, len(replaced) - 1)] for k in range(put)]
+        i, j = i + taken, j + put
+    return carried
+
+
+# ifs can be nested arbitrarily deep, so nothing below recurses into their arms: code
+# is walked breadth first, and sizes are worked out innermost first
+def nested_code(code: Code) -> list[Code]:
+    """code and the arms of every InlineIf in it, outer arms before the ones nested in them"""
+    arms = [code]
+    i = 0
+    while i < len(arms):
+        for kind, op in arms[i].entries():
+            if kind == OP_INLINE_IF:
+                arms += [op.body, op.orelse]
+        i += 1
+    return arms
+
+
+def arm_sizes(code: Code) -> dict[int, int]:
+    """Tokens that code and every arm in it assemble to, by id"""
+    sizes: dict[int, int] = {}
+    for ops in reversed(nested_code(code)):
+        size = len(ops)
+        for kind, op in ops.entries():
+            if kind == OP_INLINE_IF:
+                body, orelse = sizes[id(op.body)], sizes[id(op.orelse)]
+                # every layout holds both arms once, on top of its own tokens
+                size += len(op.layout(body, orelse)) - 3 + body + orelse
+        sizes[id(ops)] = size
+    return sizes
+
+
+def token_count(code: Code) -> int:
+    return arm_sizes(code)[id(code)]
+
+
+def code_tokens(code: Code, renamed: dict[str, str] | None = None) -> Iterator[str]:
+    """Assembles code, calling renamed[name] (if there is one) instead of every name"""
+    sizes = arm_sizes(code)
+    pending = [code.entries()]
+    while pending:
+        match next(pending[-1], None):
+            case None:
+                pending.pop()
+            case str() as token:
+                yield token
+            case Code() as arm:
+                pending.append(arm.entries())
+            case (kind, InlineIf() as op):
+                layout = op.layout(sizes[id(op.body)], sizes[id(op.orelse)])
+                pending.append(iter(layout))
+            case (kind, Call() as op):
+                name = op.assemble()
+                yield renamed.get(name, name) if renamed else name
+            case (kind, operand):
+                yield MNEMONIC[kind] or f"{operand}"
+
+
+def code_spans(code: Code) -> Iterator[Span | None]:
+    """The span of every token code_tokens(code) yields, None where code has none. The tokens
+    an inline if is laid out with take the span of the if"""
+
+    def spanned(arm: Code) -> Iterator:
+        spans = arm.spans if isinstance(arm, MappedCode) else itertools.repeat(None)
+        return zip(arm.entries(), spans)
+
+    sizes = arm_sizes(code)
+    pending = [spanned(code)]
+    while pending:
+        match next(pending[-1], None):
+            case None:
+                pending.pop()
+            case (Code() as arm, _):
+                pending.append(spanned(arm))
+            case ((_, InlineIf() as op), span):
+                layout = op.layout(sizes[id(op.body)], sizes[id(op.orelse)])
+                pending.append((item, span) for item in layout)
+            case (_, span):
+                yield span
+
+
+def ends_in_call(code: Code) -> bool:
+    # builtins are plain words, a call to one never gets a frame worth trimming
+    return (
+        len(code) > 0
+        and isinstance(code[-1], Call)
+        and code[-1].func.name not in builtin_functions()
+    )
+
+
+def ends_in_recursion(code: Code, name: str) -> bool:
+    """True if the call code ends in leads back to name, through callees that end in calls"""
+    seen: set[str] = set()
+    while ends_in_call(code):
+        callee = code[-1].func
+        if callee.name == name:
+            return True
+        if callee.name in seen:
+            return False
+        seen.add(callee.name)
+        code = callee.code
+    return False
+
+
+def copy_code(code: Code) -> Code:
+    # passes rewrite code in place, so spliced code must not share any of it
+    copied = code.copy()
+    pending = [copied]
+    while pending:
+        ops = pending.pop()
+        for i, (kind, op) in enumerate(ops.entries()):
+            if kind == OP_INLINE_IF:
+                ops[i] = op = InlineIf(
+                    op.body.copy(), op.orelse.copy(), op.else_last, op.body_last
+                )
+                pending += [op.body, op.orelse]
+    return copied
+
+
+def called_functions(code: Code):
+    for ops in nested_code(code):
+        for kind, op in ops.entries():
+            if kind == OP_CALL:
+                yield op.func
+
+
+def nested_functions(func: ClacFunc) -> list[ClacFunc]:
+    """func and all of its children, every child before its parent"""
+    order: list[ClacFunc] = []
+    pending = [(func, False)]
+    while pending:
+        current, expanded = pending.pop()
+        if expanded:
+            order.append(current)
+            continue
+        pending.append((current, True))
+        pending += [(child, False) for child in reversed(current.children)]
+    return order
+
+
+def reaches(func: ClacFunc, names: set[str]) -> bool:
+    """True if running func can end up calling any function in names"""
+    seen: set[str] = set()
+    worklist = [func]
+    while worklist:
+        current = worklist.pop()
+        for callee in called_functions(current.code):
+            if callee.name in names:
+                return True
+            if callee.name not in seen:
+                seen.add(callee.name)
+                worklist.append(callee)
+        worklist.extend(current.children)
+    return False
+
+
+# instructions a call costs on top of running the callee's code: the call and the return
+CALL_OVERHEAD = 2
 
 
 def match_operator_to_BinOp(op: ast.operator | ast.cmpop) -> BinOp:
@@ -175,26 +703,2009 @@ compares = {
     "Lt": "<",
 }
 
-if len(sys.argv) < 2:
-    print("Usage: ./main.py <file.py>")
-    exit()
+INT_MIN = -(2**31)
+
+
+def clac_int(value: int) -> int:
+    # clac integers are 32 bit two's complement and wrap around on overflow
+    value &= 0xFFFFFFFF
+    return value - 2**32 if value >= 2**31 else value
+
+
+def clac_binop(operator: str, x: int, y: int) -> int | None:
+    """Evaluates operator the way clac does, None if clac would raise an error instead"""
+    match operator:
+        case "+":
+            return clac_int(x + y)
+        case "-":
+            return clac_int(x - y)
+        case "*":
+            return clac_int(x * y)
+        case "/" | "%":
+            if y == 0 or (x == INT_MIN and y == -1):
+                return None
+            # division truncates towards zero, and the remainder takes the sign of x
+            quotient = abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1)
+            return clac_int(quotient if operator == "/" else x - y * quotient)
+        case "**":
+            if y < 0:
+                return None
+            return clac_int(pow(x, y, 2**32))
+        case "<":
+            return int(x < y)
+        case _:
+            raise Exception(f"Non-existent BinOp: {operator}")
+
+
+def is_pure(expr: ast.expr) -> bool:
+    # only calls can have side effects (print)
+    return not any(isinstance(node, ast.Call) for node in ast.walk(expr))
+
+
+class NotConstant(Exception):
+    pass
+
+
+# what a pure function can evaluate to at compile time
+ConstValue = int | tuple[int, int] | None
+
+
+def constant_value(expr: ast.expr) -> ConstValue:
+    match expr:
+        case ast.Constant(value=int(value)):
+            return value
+        case ast.Tuple(elts=[ast.Constant(value=int(x)), ast.Constant(value=int(y))]):
+            return (x, y)
+        case _:
+            raise NotConstant()
+
+
+def constant_expression(value: ConstValue, node: ast.AST) -> ast.expr:
+    match value:
+        case int():
+            return ast.copy_location(ast.Constant(value=value), node)
+        case (x, y):
+            elts = [constant_expression(x, node), constant_expression(y, node)]
+            return ast.copy_location(ast.Tuple(elts=elts, ctx=ast.Load()), node)
+        case _:
+            raise NotConstant()
+
+
+def bound_names(func: ast.FunctionDef) -> set[str]:
+    """Every name that func (or anything nested in it) binds: arguments, assignments and defs"""
+    names: set[str] = set()
+    for node in ast.walk(func):
+        match node:
+            case ast.FunctionDef():
+                names.add(node.name)
+                names.update(arg.arg for arg in node.args.args)
+            case ast.Name(ctx=ast.Store()):
+                names.add(node.id)
+    names.discard(func.name)
+    return names
+
+
+class PureFunctions:
+    """Finds the top-level functions without side effects, and evaluates calls to them at compile time"""
+
+    # statements and expressions an evaluation may run before it gives up
+    FUEL = 100_000
+
+    def __init__(self, module: ast.Module):
+        self.defs = {
+            node.name: node for node in module.body if isinstance(node, ast.FunctionDef)
+        }
+
+        # assume everything is pure, then keep removing functions that print,
+        # define closures or call something impure until nothing changes
+        self.pure = set(self.defs)
+        changed = True
+        while changed:
+            changed = False
+            for name in list(self.pure):
+                if not self.only_calls_pure(self.defs[name]):
+                    self.pure.discard(name)
+                    changed = True
+
+    def only_calls_pure(self, func: ast.FunctionDef) -> bool:
+        shadowed = bound_names(func)
+        for node in ast.walk(func):
+            match node:
+                case ast.FunctionDef() if node is not func:
+                    return False
+                case ast.Call(func=ast.Name(id=callee)):
+                    if callee in shadowed or callee not in self.pure:
+                        return False
+                case ast.Call():
+                    return False
+        return True
+
+    def evaluate(self, name: str, args: list[ConstValue]) -> ConstValue:
+        """Raises NotConstant unless the call can be evaluated exactly like clac would run it"""
+        self.fuel = self.FUEL
+        try:
+            return self.call(name, args)
+        except RecursionError:
+            raise NotConstant()
+
+    def call(self, name: str, args: list[ConstValue]) -> ConstValue:
+        if name not in self.pure:
+            raise NotConstant()
+        func = self.defs[name]
+        if len(args) != len(func.args.args):
+            raise NotConstant()
+
+        env: dict[str, ConstValue] = {}
+        for arg, value in zip(func.args.args, args):
+            self.check_type(arg.annotation, value)
+            env[arg.arg] = value
+
+        value = self.run(func.body, env)
+        self.check_type(func.returns, value)
+        return value
+
+    def check_type(self, annotation: ast.expr | None, value: ConstValue):
+        match annotation, value:
+            case ast.Name(id="int"), int():
+                pass
+            case ast.Name(id="tuple"), (int(), int()):
+                pass
+            case ast.Constant(value=None), None:
+                pass
+            case _:
+                raise NotConstant()
+
+    def run(self, body: list[ast.stmt], env: dict[str, ConstValue]) -> ConstValue:
+        for stmt in body:
+            self.fuel -= 1
+            if self.fuel < 0:
+                raise NotConstant()
+
+            match stmt:
+                case ast.Assign(targets=[ast.Name(id=name)]):
+                    env[name] = self.expr(stmt.value, env)
+                case ast.Return(value=None):
+                    return None
+                case ast.Return(value=value):
+                    return self.expr(value, env)
+                case ast.If() if always_returns(stmt.body) and always_returns(
+                    stmt.orelse
+                ):
+                    # an if that does not return on both paths discards the frame, keep those at runtime
+                    test = self.expr(stmt.test, env)
+                    if not isinstance(test, int):
+                        raise NotConstant()
+                    return self.run(stmt.body if test else stmt.orelse, env)
+                case ast.Expr():
+                    self.expr(stmt.value, env)
+                case ast.Pass():
+                    pass
+                case _:
+                    raise NotConstant()
+
+        # falling off the end only returns something sensible for void functions
+        return None
+
+    def expr(self, node: ast.expr, env: dict[str, ConstValue]) -> ConstValue:
+        self.fuel -= 1
+        if self.fuel < 0:
+            raise NotConstant()
+
+        match node:
+            case ast.Constant(value=int(value)):
+                return value
+            case ast.Name(id=name) if name in env:
+                return env[name]
+            case ast.Tuple(elts=[x, y]):
+                return (self.int_expr(x, env), self.int_expr(y, env))
+            case ast.UnaryOp(op=ast.USub(), operand=operand):
+                return clac_int(-self.int_expr(operand, env))
+            case ast.BinOp():
+                operator = match_operator_to_BinOp(node.op).operator
+                return self.binop(operator, node.left, node.right, env)
+            case ast.Compare(ops=[op], comparators=[right]):
+                operator = match_operator_to_BinOp(op).operator
+                return self.binop(operator, node.left, right, env)
+            case ast.Subscript(value=value, slice=index):
+                pair = self.expr(value, env)
+                i = self.expr(index, env)
+                if not isinstance(pair, tuple) or i not in (0, 1):
+                    raise NotConstant()
+                return pair[i]
+            case ast.Call(func=ast.Name(id=name), args=args, keywords=[]):
+                return self.call(name, [self.expr(arg, env) for arg in args])
+            case _:
+                raise NotConstant()
+
+    def int_expr(self, node: ast.expr, env: dict[str, ConstValue]) -> int:
+        value = self.expr(node, env)
+        if not isinstance(value, int):
+            raise NotConstant()
+        return value
+
+    def binop(self, operator, left, right, env) -> int:
+        value = clac_binop(
+            operator, self.int_expr(left, env), self.int_expr(right, env)
+        )
+        if value is None:
+            raise NotConstant()
+        return value
+
+
+# python's own visitors recurse once per level of nesting, which a long elif chain or a
+# big expression runs out of. the passes below are written as generators instead: a step
+# yields the steps it depends on and gets their result back, and run_steps keeps the
+# pending ones on a list, so the depth a program can be nested to is only bounded by memory
+Steps = Generator[Any, Any, Any]
+
+
+def run_steps(steps: Steps) -> Any:
+    pending = [steps]
+    value, error = None, None
+    while True:
+        try:
+            if error is None:
+                request = pending[-1].send(value)
+            else:
+                request = pending[-1].throw(error)
+        except StopIteration as done:
+            pending.pop()
+            if not pending:
+                return done.value
+            value, error = done.value, None
+            continue
+        except BaseException as e:
+            pending.pop()
+            if not pending:
+                raise
+            value, error = None, e
+            continue
+        pending.append(request)
+        value, error = None, None
+
+
+def finished(value: Any = None) -> Steps:
+    # a step that has nothing left to run
+    return value
+    yield
+
+
+def visit_steps(visitor: ast.NodeVisitor, node: ast.AST) -> Steps:
+    """The steps of visitor's method for node, visit_ methods can be generators or plain functions"""
+    method = getattr(visitor, f"visit_{type(node).__name__}", visitor.generic_visit)
+    result = method(node)
+    return result if isinstance(result, Generator) else finished(result)
+
+
+class StepTransformer(ast.NodeTransformer):
+    """A NodeTransformer that runs on an explicit stack. visit_ methods may be generators
+    that yield self.generic_visit(node), or any other steps, to transform what is below them"""
+
+    def visit(self, node: ast.AST) -> Any:
+        return run_steps(visit_steps(self, node))
+
+    def generic_visit(self, node: ast.AST) -> Steps:
+        for field, old_value in ast.iter_fields(node):
+            if isinstance(old_value, list):
+                new_values = []
+                for value in old_value:
+                    if isinstance(value, ast.AST):
+                        value = yield visit_steps(self, value)
+                        if value is None:
+                            continue
+                        elif not isinstance(value, ast.AST):
+                            new_values.extend(value)
+                            continue
+                    new_values.append(value)
+                old_value[:] = new_values
+            elif isinstance(old_value, ast.AST):
+                new_node = yield visit_steps(self, old_value)
+                if new_node is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, new_node)
+        return node
+
+
+class ConstantFolder(StepTransformer):
+    """Evaluates constant subexpressions and removes arithmetic identities"""
+
+    def __init__(
+        self,
+        pure: PureFunctions | None = None,
+        shadowed: frozenset[str] | set[str] = frozenset(),
+    ):
+        # calls to pure functions with constant arguments are evaluated too,
+        # unless the function name is rebound locally
+        self.pure = pure
+        self.shadowed = shadowed
+
+    def constant(self, value: int, node: ast.expr) -> ast.Constant:
+        return ast.copy_location(ast.Constant(value=value), node)
+
+    def visit_Call(self, node: ast.Call):
+        yield self.generic_visit(node)
+        if self.pure is None or not isinstance(node.func, ast.Name):
+            return node
+        if node.func.id in self.shadowed:
+            return node
+
+        try:
+            args = [constant_value(arg) for arg in node.args]
+            value = self.pure.evaluate(node.func.id, args)
+            return constant_expression(value, node)
+        except NotConstant:
+            return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        yield self.generic_visit(node)
+        match node:
+            case ast.UnaryOp(op=ast.USub(), operand=ast.Constant(value=int(value))):
+                return self.constant(clac_int(-value), node)
+            case ast.UnaryOp(op=ast.UAdd(), operand=ast.Constant(value=int())):
+                return node.operand
+        return node
+
+    def visit_BinOp(self, node: ast.BinOp):
+        yield self.generic_visit(node)
+        operator = match_operator_to_BinOp(node.op).operator
+
+        match node.left, node.right:
+            case ast.Constant(value=int(x)), ast.Constant(value=int(y)):
+                value = clac_binop(operator, x, y)
+                if value is not None:
+                    return self.constant(value, node)
+
+        left = node.left.value if isinstance(node.left, ast.Constant) else None
+        right = node.right.value if isinstance(node.right, ast.Constant) else None
+        match operator:
+            case "+" if right == 0:
+                return node.left
+            case "+" if left == 0:
+                return node.right
+            case "-" if right == 0:
+                return node.left
+            case "*" if right == 1:
+                return node.left
+            case "*" if left == 1:
+                return node.right
+            case "*" if right == 0 and is_pure(node.left):
+                return self.constant(0, node)
+            case "*" if left == 0 and is_pure(node.right):
+                return self.constant(0, node)
+            case "/" | "**" if right == 1:
+                return node.left
+            case "%" if right == 1 and is_pure(node.left):
+                return self.constant(0, node)
+            case "**" if right == 0 and is_pure(node.left):
+                return self.constant(1, node)
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        yield self.generic_visit(node)
+        match node:
+            case ast.Compare(
+                left=ast.Constant(value=int(x)),
+                ops=[op],
+                comparators=[ast.Constant(value=int(y))],
+            ):
+                value = clac_binop(match_operator_to_BinOp(op).operator, x, y)
+                if value is not None:
+                    return self.constant(value, node)
+        return node
+
+    def visit_Subscript(self, node: ast.Subscript):
+        yield self.generic_visit(node)
+        # (a, b)[0] -> a
+        match node:
+            case ast.Subscript(
+                value=ast.Tuple(elts=[_, _] as elts),
+                slice=ast.Constant(value=0 | 1 as index),
+                ctx=ast.Load(),
+            ) if is_pure(elts[1 - index]):
+                return elts[index]
+        return node
+
+
+class ConstantSubstituter(StepTransformer):
+    # replaces loads of the given locals with their constant values
+    def __init__(self, constants: dict[str, ConstValue]):
+        self.constants = constants
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        # nested functions are compiled separately, leave their names alone
+        return node
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            return constant_expression(self.constants[node.id], node)
+        return node
+
+
+def single_constant_assignments(func: ast.FunctionDef) -> dict[str, ConstValue]:
+    """Locals that are assigned exactly once, to a constant"""
+    assignments: dict[str, list[ast.expr | None]] = {}
+    for node in ast.walk(func):
+        match node:
+            case ast.Assign(targets=[ast.Name(id=name)], value=value):
+                assignments.setdefault(name, []).append(value)
+            # these rebind their target too, to something that is not known here
+            case ast.AugAssign(target=ast.Name(id=name)):
+                assignments.setdefault(name, []).append(None)
+            case ast.For(target=target):
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        assignments.setdefault(name.id, []).append(None)
+            case ast.FunctionDef():
+                for arg in node.args.args:
+                    assignments.setdefault(arg.arg, []).append(None)
+
+    constants: dict[str, ConstValue] = {}
+    for name, values in assignments.items():
+        if len(values) != 1 or values[0] is None:
+            continue
+        try:
+            constants[name] = constant_value(values[0])
+        except NotConstant:
+            pass
+    return constants
+
+
+def fold_function(func: ast.FunctionDef, pure: PureFunctions | None) -> ast.FunctionDef:
+    """Folds constants in a top-level function, propagating locals that end up constant"""
+    folder = ConstantFolder(pure, bound_names(func))
+    func = folder.visit(func)
+
+    propagated: set[str] = set()
+    while True:
+        constants = {
+            name: value
+            for name, value in single_constant_assignments(func).items()
+            if name not in propagated
+        }
+        if not constants:
+            return func
+
+        propagated.update(constants)
+        # substitute in our own body, but not in the nested functions
+        substituter = ConstantSubstituter(constants)
+        func = folder.visit(run_steps(substituter.generic_visit(func)))
+
+
+# peephole optimizer: a rule looks at a fixed-width window of the opcode stream
+# and either returns a shorter sequence with the same stack effect, or None
+@dataclass
+class PeepholeRule:
+    name: str
+    width: int
+    rewrite: Callable[[list[OpCode]], list[OpCode] | None]
+
+
+def is_push(op: OpCode, value: int | None = None) -> bool:
+    return isinstance(op, Push) and (value is None or op.value == value)
+
+
+def is_binop(op: OpCode, operator: str) -> bool:
+    return isinstance(op, BinOp) and op.operator == operator
+
+
+def rewrite_push_drop(w: list[OpCode]) -> list[OpCode] | None:
+    # c drop -> (nothing)
+    if is_push(w[0]) and isinstance(w[1], Drop):
+        return []
+    return None
+
+
+def rewrite_pick_drop(w: list[OpCode]) -> list[OpCode] | None:
+    # k pick drop -> (nothing)
+    if is_push(w[0]) and isinstance(w[1], Pick) and isinstance(w[2], Drop):
+        return []
+    return None
+
+
+def rewrite_pick_known_top(w: list[OpCode]) -> list[OpCode] | None:
+    # c 1 pick -> c c
+    if is_push(w[0]) and is_push(w[1], 1) and isinstance(w[2], Pick):
+        return [Push(w[0].value), Push(w[0].value)]
+    return None
+
+
+def rewrite_const_subscript(w: list[OpCode]) -> list[OpCode] | None:
+    # a b 2 pick rot rot drop drop -> a b drop
+    # a b 1 pick rot rot drop drop -> a b swap drop
+    if not (is_push(w[0]) and isinstance(w[1], Pick)):
+        return None
+    if not (isinstance(w[2], Rot) and isinstance(w[3], Rot)):
+        return None
+    if not (isinstance(w[4], Drop) and isinstance(w[5], Drop)):
+        return None
+    match w[0].value:
+        case 2:
+            return [Drop()]
+        case 1:
+            return [Swap(), Drop()]
+        case _:
+            return None
+
+
+def rewrite_sink_const(w: list[OpCode]) -> list[OpCode] | None:
+    # c swap drop -> drop c
+    if is_push(w[0]) and isinstance(w[1], Swap) and isinstance(w[2], Drop):
+        return [Drop(), Push(w[0].value)]
+    return None
+
+
+def rewrite_sink_pick(w: list[OpCode]) -> list[OpCode] | None:
+    # 1 pick swap drop -> (nothing)
+    # k pick swap drop -> drop k-1 pick
+    if not (is_push(w[0]) and isinstance(w[1], Pick)):
+        return None
+    if not (isinstance(w[2], Swap) and isinstance(w[3], Drop)):
+        return None
+    if w[0].value == 1:
+        return []
+    return [Drop(), Push(w[0].value - 1), Pick()]
+
+
+def rewrite_sink_const_pair(w: list[OpCode]) -> list[OpCode] | None:
+    # c d rot drop -> drop c d
+    if is_push(w[0]) and is_push(w[1]) and isinstance(w[2], Rot):
+        if isinstance(w[3], Drop):
+            return [Drop(), Push(w[0].value), Push(w[1].value)]
+    return None
+
+
+def rewrite_swap_swap(w: list[OpCode]) -> list[OpCode] | None:
+    if isinstance(w[0], Swap) and isinstance(w[1], Swap):
+        return []
+    return None
+
+
+def rewrite_rot_rot_rot(w: list[OpCode]) -> list[OpCode] | None:
+    if all(isinstance(op, Rot) for op in w):
+        return []
+    return None
+
+
+def rewrite_identity(w: list[OpCode]) -> list[OpCode] | None:
+    # x 0 + -> x, x 0 - -> x, x 1 * -> x, x 1 / -> x
+    match w:
+        case [Push(value=0), BinOp(operator="+" | "-")]:
+            return []
+        case [Push(value=1), BinOp(operator="*" | "/")]:
+            return []
+    return None
+
+
+PEEPHOLE_RULES: list[PeepholeRule] = [
+    PeepholeRule("push-drop", 2, rewrite_push_drop),
+    PeepholeRule("pick-drop", 3, rewrite_pick_drop),
+    PeepholeRule("pick-known-top", 3, rewrite_pick_known_top),
+    PeepholeRule("const-subscript", 6, rewrite_const_subscript),
+    PeepholeRule("sink-const", 3, rewrite_sink_const),
+    PeepholeRule("sink-pick", 4, rewrite_sink_pick),
+    PeepholeRule("sink-const-pair", 4, rewrite_sink_const_pair),
+    PeepholeRule("swap-swap", 2, rewrite_swap_swap),
+    PeepholeRule("rot-rot-rot", 3, rewrite_rot_rot_rot),
+    PeepholeRule("identity", 2, rewrite_identity),
+]
+
+
+def peephole(code: Code, rules: list[PeepholeRule]) -> int:
+    """Rewrites code (and the arms in it) in place until no rule applies, returns the number of instructions removed"""
+    if not rules:
+        return 0
+
+    removed = 0
+    for arm in reversed(nested_code(code)):
+        ops = list(arm)
+        if saved := peephole_list(ops, rules):
+            arm[:] = ops
+            removed += saved
+    return removed
+
+
+def peephole_list(code: list[OpCode], rules: list[PeepholeRule]) -> int:
+    removed = 0
+    max_width = max(rule.width for rule in rules)
+    i = 0
+    while i < len(code):
+        for rule in rules:
+            window = code[i : i + rule.width]
+            # if consumes the next three tokens, so never rewrite across control flow
+            if len(window) < rule.width or any(
+                isinstance(op, (If, Skip)) for op in window
+            ):
+                continue
+
+            replacement = rule.rewrite(window)
+            if replacement is None:
+                continue
+
+            assert len(replacement) < len(window), (
+                f"peephole rule {rule.name} must shrink the code"
+            )
+            assert sum(op.stack_delta() for op in window) == sum(
+                op.stack_delta() for op in replacement
+            ), f"peephole rule {rule.name} changed the stack delta"
+
+            code[i : i + rule.width] = replacement
+            removed += len(window) - len(replacement)
+            # a rewrite can complete a pattern that started before it
+            i = max(i - max_width + 1, 0)
+            break
+        else:
+            i += 1
+
+    return removed
+
+
+def optimize(func: ClacFunc, rules: list[PeepholeRule]) -> dict[str, int]:
+    """Runs the peephole pass over func and all of its children, returns instructions removed per function"""
+    return {f.name: peephole(f.code, rules) for f in nested_functions(func)}
+
+
+# stack scheduling: in straight-line code only binops and calls compute anything, the
+# pushes, picks, swaps, rots and drops around them just move values into place. a block
+# is traced into the values it computes, then the moves are derived again from scratch,
+# bringing each operand to the top the cheapest way the stack allows
+COMMUTATIVE = {"+", "*"}
+
+# the final shuffle is searched exhaustively up to this many states before falling back,
+# and not at all once more than this many cells would have to move
+ARRANGE_SEARCH_LIMIT = 5000
+ARRANGE_MAX_CELLS = 12
+
+# what the scheduler tracks grows with the block, so longer runs are scheduled this many
+# instructions at a time, which keeps scheduling linear in the length of the code
+SCHEDULE_WINDOW = 256
+
+
+@dataclass
+class Block:
+    # cells below the block that it reads or rewrites, bottom first (as value ids)
+    entry: list[int]
+    # (instruction, operand ids, result ids), in the order they have to run
+    events: list[tuple[OpCode, list[int], list[int]]]
+    # what those cells hold once the block is done
+    final: list[int]
+    # ids of values that are plain constants, which can be pushed again instead of kept
+    constants: dict[int, int]
+
+
+def trace_block(code: list[OpCode]) -> Block | None:
+    """Symbolically runs straight-line code, None if a pick index is not a known constant"""
+    next_id = 0
+    stack: list[int] = []
+    entry: list[int] = []
+    constants: dict[int, int] = {}
+    events: list[tuple[OpCode, list[int], list[int]]] = []
+
+    def fresh() -> int:
+        nonlocal next_id
+        next_id += 1
+        return next_id - 1
+
+    def reach(depth: int):
+        # cells the block has not seen yet belong to whoever ran before it
+        while len(stack) < depth:
+            cell = fresh()
+            stack.insert(0, cell)
+            entry.insert(0, cell)
+
+    for op in code:
+        match op:
+            case Push():
+                constants[value := fresh()] = op.value
+                stack.append(value)
+            case Pick():
+                reach(1)
+                index = constants.get(stack.pop(), 0)
+                if index < 1:
+                    return None
+                reach(index)
+                stack.append(stack[-index])
+            case Swap():
+                reach(2)
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            case Rot():
+                reach(3)
+                stack.append(stack.pop(-3))
+            case Drop():
+                reach(1)
+                stack.pop()
+            case BinOp() | Call():
+                consumed = 2 if isinstance(op, BinOp) else op.func.arg_count
+                produced = 1 if isinstance(op, BinOp) else op.func.ret_count
+                reach(consumed)
+                operands = stack[len(stack) - consumed :]
+                del stack[len(stack) - consumed :]
+                results = [fresh() for _ in range(produced)]
+                events.append((op, operands, results))
+                stack.extend(results)
+            case _:
+                raise Exception(f"cannot trace {op}")
+
+    return Block(entry, events, stack, constants)
+
+
+class Scheduler:
+    def __init__(self, block: Block):
+        self.block = block
+        self.stack = list(block.entry)
+        # reads left of every value, a cell is spare once its value has more copies than reads
+        self.uses: Counter[int] = Counter(block.final)
+        for _, operands, _ in block.events:
+            self.uses.update(operands)
+        self.code: list[OpCode] = []
+
+    def fork(self) -> "Scheduler":
+        other = Scheduler.__new__(Scheduler)
+        other.block = self.block
+        other.stack = list(self.stack)
+        other.uses = Counter(self.uses)
+        other.code = list(self.code)
+        return other
+
+    def spare(self, value: int) -> bool:
+        return self.stack.count(value) > self.uses[value]
+
+    def drop_spare(self):
+        # drop, swap drop and rot drop can reach the top three cells
+        depth = 1
+        while depth <= min(3, len(self.stack)):
+            if not self.spare(self.stack[-depth]):
+                depth += 1
+                continue
+            self.code += [[], [Swap()], [Rot()]][depth - 1] + [Drop()]
+            del self.stack[-depth]
+            depth = 1
+
+    def load(self, value: int, placed: int):
+        """Brings value to the top, above the placed operands already there"""
+        self.uses[value] -= 1
+        if value in self.block.constants:
+            self.code.append(Push(self.block.constants[value]))
+            self.stack.append(value)
+            return
+
+        depths = [
+            depth
+            for depth in range(placed + 1, len(self.stack) + 1)
+            if self.stack[-depth] == value
+        ]
+        depth = depths[0] if depths else self.stack[::-1].index(value) + 1
+
+        # moving takes the cell away, so only do it when no later read needs it
+        if len(depths) > self.uses[value] and depth <= 3:
+            self.code += [[], [Swap()], [Rot()]][depth - 1]
+            self.stack.append(self.stack.pop(-depth))
+        else:
+            self.code += [Push(depth), Pick()]
+            self.stack.append(value)
+
+    def run_event(self, op: OpCode, operands: list[int], results: list[int]):
+        for placed, value in enumerate(operands):
+            self.load(value, placed)
+        self.code.append(op)
+        del self.stack[len(self.stack) - len(operands) :]
+        self.stack += results
+        self.drop_spare()
+
+    def schedule(self) -> list[OpCode] | None:
+        self.drop_spare()
+        for op, operands, results in self.block.events:
+            if is_binop(op, "+") or is_binop(op, "*"):
+                swapped = self.fork()
+                swapped.run_event(op, operands[::-1], results)
+                self.run_event(op, operands, results)
+                # straight-line code is one token per instruction
+                if len(swapped.code) < len(self.code):
+                    self.stack, self.uses, self.code = (
+                        swapped.stack,
+                        swapped.uses,
+                        swapped.code,
+                    )
+            else:
+                self.run_event(op, operands, results)
+
+        tail = arrange(self.stack, self.block.final, self.block.constants)
+        if tail is None:
+            return None
+        return self.code + tail
+
+
+def arrange(
+    stack: list[int], target: list[int], constants: dict[int, int]
+) -> list[OpCode] | None:
+    """Cheapest shuffle that turns stack into target, None if it cannot be found"""
+    keep = 0
+    while keep < min(len(stack), len(target)) and stack[keep] == target[keep]:
+        keep += 1
+
+    wanted = Counter(target)
+    best = rebuild(stack, target, keep, constants)
+    if max(len(stack), len(target)) - keep > ARRANGE_MAX_CELLS:
+        return best
+
+    def estimate(state: tuple[int, ...]) -> int:
+        # every missing copy costs a push or pick, every extra cell a drop
+        have = Counter(state)
+        return sum(abs(wanted[v] - have[v]) for v in wanted.keys() | have.keys())
+
+    start = tuple(stack)
+    frontier = [(estimate(start), 0, start, ())]
+    seen = {start: 0}
+    expanded = 0
+    while frontier and expanded < ARRANGE_SEARCH_LIMIT:
+        _, cost, state, moves = heapq.heappop(frontier)
+        if best is not None and cost >= len(best):
+            break
+        if state == tuple(target):
+            return list(moves)
+        expanded += 1
+
+        have = Counter(state)
+        steps: list[tuple[tuple[int, ...], tuple[OpCode, ...]]] = []
+        # cells below keep are already in place, so leave them alone
+        movable = len(state) - keep
+        if movable >= 1 and have[state[-1]] > wanted[state[-1]]:
+            steps.append((state[:-1], (Drop(),)))
+        if movable >= 2:
+            steps.append((state[:-2] + (state[-1], state[-2]), (Swap(),)))
+        if movable >= 3:
+            steps.append((state[:-3] + state[-2:] + (state[-3],), (Rot(),)))
+        for value in wanted:
+            if have[value] >= wanted[value]:
+                continue
+            if value in constants:
+                steps.append((state + (value,), (Push(constants[value]),)))
+            elif value in state:
+                depth = state[::-1].index(value) + 1
+                steps.append((state + (value,), (Push(depth), Pick())))
+
+        for next_state, step in steps:
+            next_cost = cost + len(step)
+            if seen.get(next_state, next_cost + 1) <= next_cost:
+                continue
+            seen[next_state] = next_cost
+            heapq.heappush(
+                frontier,
+                (
+                    next_cost + estimate(next_state),
+                    next_cost,
+                    next_state,
+                    moves + step,
+                ),
+            )
+
+    return best
+
+
+def rebuild(
+    stack: list[int], target: list[int], keep: int, constants: dict[int, int]
+) -> list[OpCode] | None:
+    # copy the (at most two) wanted cells to the top, then sink everything between
+    # them and the cells that are already in place
+    wanted = target[keep:]
+    if len(wanted) > 2 or any(v not in constants and v not in stack for v in wanted):
+        return None
+
+    code: list[OpCode] = []
+    state = list(stack)
+    for value in wanted:
+        if value in constants:
+            code.append(Push(constants[value]))
+        else:
+            code += [Push(state[::-1].index(value) + 1), Pick()]
+        state.append(value)
+
+    sink = [[Drop()], [Swap(), Drop()], [Rot(), Drop()]][len(wanted)]
+    return code + sink * (len(stack) - keep)
+
+
+def schedule(code: Code) -> int:
+    """Re-derives the stack moves of every straight-line run in code (and the arms in it), returns the instructions removed"""
+    removed = 0
+    for arm in reversed(nested_code(code)):
+        ops = list(arm)
+        if saved := schedule_list(ops):
+            arm[:] = ops
+            removed += saved
+    return removed
+
+
+def schedule_list(code: list[OpCode]) -> int:
+    removed = 0
+    i = 0
+    while i < len(code):
+        # the stack has to look exactly the same as before at anything the trace cannot see through:
+        # control flow, calls that read their caller's frame and picks with a computed index
+        end = i
+        while end < len(code) and end - i < SCHEDULE_WINDOW:
+            match code[end]:
+                case Push() | Swap() | Rot() | Drop() | BinOp():
+                    pass
+                case Pick() if end > i and isinstance(code[end - 1], Push):
+                    pass
+                case Call() if code[end].func.own_frame:
+                    pass
+                case _:
+                    break
+            end += 1
+
+        original = code[i:end]
+        block = trace_block(original)
+        scheduled = None if block is None else Scheduler(block).schedule()
+        if (
+            scheduled is not None
+            and len(scheduled) < len(original)
+            # keep a call that ends the run last, it may be a tail call
+            and ends_in_call(scheduled) >= ends_in_call(original)
+        ):
+            assert sum(op.stack_delta() for op in scheduled) == sum(
+                op.stack_delta() for op in original
+            ), "scheduling changed the stack delta"
+            code[i:end] = scheduled
+            removed += len(original) - len(scheduled)
+            end = i + len(scheduled)
+        i = end + 1
+
+    return removed
+
+
+def schedule_function(func: ClacFunc) -> dict[str, int]:
+    """Runs the scheduler over func and all of its children, returns instructions removed per function"""
+    return {f.name: schedule(f.code) for f in nested_functions(func)}
+
+
+# frame cleanup: a frame under the values a function returns is dropped one cell at a time,
+# and every cell has to get past those values (swap or rot) before it can go, so nothing
+# executes fewer instructions. long cleanups are called instead, from words that each drop a
+# power of two cells, so a return site takes one token per set bit of its frame size
+
+# what drops one cell from under the cells on top, by how many there are
+CLEANUP_STEPS = {0: (OP_DROP,), 1: (OP_SWAP, OP_DROP), 2: (OP_ROT, OP_DROP)}
+# cleanups shorter than this many cells are left as they are
+CLEANUP_MIN_CELLS = 4
+
+
+@functools.cache
+def cleanup_word(width: int, cells: int) -> ClacFunc:
+    """Drops cells cells from under the top width cells"""
+    steps = [SHARED_OPCODES[kind] for kind in CLEANUP_STEPS[width]]
+    name = "".join(op.assemble() for op in steps).upper()
+    return ClacFunc(
+        f"__{name}{cells}", cells + width, width, Code(steps * cells), [], shared=True
+    )
+
+
+def cleanup_run(ops: list[Entry], i: int) -> tuple[int, int]:
+    """The width and number of cells dropped by the cleanup starting at ops[i]"""
+    for width in (1, 2, 0):
+        steps = CLEANUP_STEPS[width]
+        cells = 0
+        while tuple(kind for kind, _ in ops[i : i + len(steps)]) == steps:
+            cells += 1
+            i += len(steps)
+        if cells:
+            return width, cells
+    return 0, 0
+
+
+def call_cleanups(code: Code) -> int:
+    """Replaces the long frame cleanups in code (and the arms in it) with calls to cleanup
+    words, returns the number of tokens saved"""
+    saved = 0
+    for arm in nested_code(code):
+        ops = list(arm.entries())
+        lowered: list[OpCode] = []
+        shortened = 0
+        i = 0
+        while i < len(ops):
+            width, cells = cleanup_run(ops, i)
+            if cells < CLEANUP_MIN_CELLS:
+                lowered.append(view(*ops[i]))
+                i += 1
+                continue
+            size = cells * len(CLEANUP_STEPS[width])
+            calls = [
+                Call(cleanup_word(width, 1 << bit))
+                for bit in reversed(range(cells.bit_length()))
+                if cells >> bit & 1
+            ]
+            lowered += calls
+            shortened += size - len(calls)
+            i += size
+        if shortened:
+            arm[:] = lowered
+            saved += shortened
+    return saved
+
+
+def call_cleanups_function(func: ClacFunc) -> dict[str, int]:
+    """Runs call_cleanups over func and all of its children, returns tokens saved per function"""
+    return {f.name: call_cleanups(f.code) for f in nested_functions(func)}
+
+
+# stack verification: FunctionCompiler keeps track of the stack by hand while it emits code,
+# this works the same out again from nothing but the code and what each call declares
+
+# how many cells on top of the stack an instruction needs, by kind (pick also reaches down
+# to the cell it copies, calls and inline ifs depend on what they run)
+STACK_READS: tuple[int | None, ...] = (0, 1, 2, 3, 1, 1, 1, 2, None, None)
+
+
+@dataclass
+class StackEffect:
+    """What the code of a definition does to the stack. Heights count cells above the ones under
+    its arguments (so it starts at arg_count), calls include what the callee does"""
+
+    name: str
+    arg_count: int
+    ret_count: int
+    # net effect worked out from the code, it has to be ret_count - arg_count
+    delta: int
+    # highest and lowest the stack gets, lowest is only below 0 for arms reading their parent
+    peak: int
+    lowest: int
+    # tokens in the definition
+    instructions: int
+    # calls itself somewhere below, so peak only covers one level of each recursive call
+    recursive: bool = False
+    # picks whose depth is only known at run time reach wherever they like
+    dynamic_picks: int = 0
+    errors: tuple[str, ...] = ()
+
+
+class StackVerifier:
+    """Works out the StackEffect of every definition it is given, and checks it against what the
+    compiler declared. Functions have to be given in the order they were compiled"""
+
+    def __init__(self):
+        self.effects: dict[str, StackEffect] = {}
+        # the function being verified and everything nested in it, their calls are recursive
+        self.pending: set[str] = set()
+        # calls into pending definitions, with the counts that were declared at the time
+        self.assumed: list[tuple[str, ClacFunc]] = []
+
+    def verify(self, func: ClacFunc) -> list[StackEffect]:
+        """Effects of func and everything nested in it, children first"""
+        functions = nested_functions(func)
+        self.pending = {f.name for f in functions}
+        self.assumed = []
+        effects = []
+        for f in functions:
+            effects.append(self.analyze(f))
+            self.effects[f.name] = effects[-1]
+            self.pending.discard(f.name)
+
+        # a placeholder stood in for func while it was compiled, check it told the truth
+        for caller, callee in self.assumed:
+            effect = self.effects[callee.name]
+            if (callee.arg_count, callee.ret_count) != (
+                effect.arg_count,
+                effect.ret_count,
+            ):
+                error = (
+                    f"{caller} calls {callee.name} as taking {callee.arg_count} and "
+                    f"returning {callee.ret_count}, it takes {effect.arg_count} "
+                    f"and returns {effect.ret_count}"
+                )
+                self.effects[caller].errors += (error,)
+        return effects
+
+    def effect_of(self, caller: str, callee: ClacFunc) -> StackEffect:
+        if callee.name in self.pending:
+            self.assumed.append((caller, callee))
+            return StackEffect(
+                callee.name,
+                callee.arg_count,
+                callee.ret_count,
+                callee.ret_count - callee.arg_count,
+                peak=callee.arg_count,
+                lowest=0,
+                instructions=0,
+                recursive=True,
+            )
+        if callee.name not in self.effects:
+            # builtins, and shared words that no function was verified with yet
+            self.effects[callee.name] = self.analyze(callee)
+        return self.effects[callee.name]
+
+    def analyze(self, func: ClacFunc) -> StackEffect:
+        if func.name in builtin_functions():
+            return StackEffect(
+                func.name,
+                func.arg_count,
+                func.ret_count,
+                func.ret_count - func.arg_count,
+                peak=max(func.arg_count, func.ret_count),
+                lowest=0,
+                instructions=0,
+            )
 
-print("Seirea CLAC Compiler v0.1.0")
-with open(sys.argv[1], "r") as f:
-    tree = ast.parse(f.read())
-# tree = ast.parse(source5)
-print(ast.dump(tree, indent=4))
+        errors: list[str] = []
+        recursive = False
+        dynamic_picks = 0
+        # (delta, peak, lowest) of every arm, relative to the height it starts at
+        arms: dict[int, tuple[int, int, int]] = {}
+        for arm in reversed(nested_code(func.code)):
+            height = peak = lowest = 0
+            previous: Entry | None = None
+            for kind, operand in arm.entries():
+                if kind == OP_CALL:
+                    effect = self.effect_of(func.name, operand.func)
+                    recursive |= effect.recursive
+                    base = height - effect.arg_count
+                    peak = max(peak, base + effect.peak)
+                    lowest = min(lowest, base + effect.lowest)
+                    height = base + effect.ret_count
+                elif kind == OP_INLINE_IF:
+                    height -= 1
+                    lowest = min(lowest, height)
+                    body, orelse = arms[id(operand.body)], arms[id(operand.orelse)]
+                    if body[0] != orelse[0]:
+                        errors.append(
+                            f"the arms of an if change the stack by {body[0]} and {orelse[0]}"
+                        )
+                    peak = max(peak, height + body[1], height + orelse[1])
+                    lowest = min(lowest, height + body[2], height + orelse[2])
+                    height += body[0]
+                else:
+                    if kind in (OP_IF, OP_SKIP):
+                        errors.append(f"{MNEMONIC[kind]} outside of an inline if")
+                    lowest = min(lowest, height - STACK_READS[kind])
+                    if kind == OP_PICK and previous and previous[0] == OP_PUSH:
+                        if previous[1] < 1:
+                            errors.append(f"picks element {previous[1]}")
+                        lowest = min(lowest, height - 1 - previous[1])
+                    elif kind == OP_PICK:
+                        dynamic_picks += 1
+                    height += STACK_DELTA[kind]
+                    peak = max(peak, height)
+                previous = (kind, operand)
+            arms[id(arm)] = (height, peak, lowest)
+
+        delta, peak, lowest = arms[id(func.code)]
+        if delta != func.ret_count - func.arg_count:
+            errors.append(
+                f"changes the stack by {delta}, but takes {func.arg_count} "
+                f"and returns {func.ret_count}"
+            )
+        lowest += func.arg_count
+        if lowest < 0 and func.own_frame:
+            errors.append(f"reaches {-lowest} cells below its arguments")
+        return StackEffect(
+            func.name,
+            func.arg_count,
+            func.ret_count,
+            delta,
+            func.arg_count + peak,
+            lowest,
+            token_count(func.code),
+            recursive,
+            dynamic_picks,
+            tuple(errors),
+        )
+
+
+@dataclass(frozen=True)
+class CompilerOptions:
+    # names of the peephole rules to run
+    peephole_rules: tuple[str, ...] = tuple(rule.name for rule in PEEPHOLE_RULES)
+    # inline if-arms that assemble to at most this many tokens (0 outlines every arm)
+    inline_if_threshold: int = 24
+    # inline calls to functions that assemble to at most this many tokens (0 disables inlining)
+    inline_threshold: int = 16
+    fold: bool = True
+    const_eval: bool = True
+    liveness: bool = True
+    schedule: bool = True
+    tail_calls: bool = True
+    # call shared words for long frame cleanups instead of spelling every cell out
+    cleanup_words: bool = False
+    # emit one definition for every body, instead of one for every function and arm that has it
+    dedup: bool = True
+    # factor runs of stack instructions that recur across the module out into helper words
+    superinstructions: bool = False
+    # only emit definitions reachable from entry_points (the functions called at module level if empty)
+    shake: bool = False
+    entry_points: tuple[str, ...] = ()
+    # keep the source span of every instruction, for source maps
+    source_map: bool = False
+    # unroll range loops that run a constant number of times, at most this many (0 never unrolls)
+    unroll_limit: int = 8
+
+    def rules(self) -> list[PeepholeRule]:
+        return [rule for rule in PEEPHOLE_RULES if rule.name in self.peephole_rules]
 
 
 def generate_error_message(message: str, node: ast.expr | ast.stmt):
     return f"{message} | Line {node.lineno} Col {node.col_offset}"
 
 
+def count_loads(
+    body: list[ast.stmt], counted: dict[ast.If, Counter[str] | None]
+) -> Counter[str] | None:
+    """How many times each name is read, None if a nested function could capture any of them.
+    Loop helpers count as one read of everything they read. Ifs found in counted are not
+    walked again"""
+    loads: Counter[str] = Counter()
+    pending: list[ast.AST] = list(body)
+    while pending:
+        node = pending.pop()
+        match node:
+            case ast.If() if node in counted:
+                if (nested := counted[node]) is None:
+                    return None
+                loads.update(nested)
+                continue
+            case ast.FunctionDef() if LOOP_HELPER in node.name:
+                # called once, right where it is defined, and the frame must not shift under
+                # what it captures until then (its arguments neither, moving one into the
+                # call would shift it too)
+                if (nested := count_loads(node.body, counted)) is None:
+                    return None
+                loads.update(set(nested))
+                continue
+            case ast.FunctionDef():
+                return None
+            case ast.Name(ctx=ast.Load()):
+                loads[node.id] += 1
+        pending.extend(ast.iter_child_nodes(node))
+    return loads
+
+
+def count_if_loads(func: ast.FunctionDef) -> dict[ast.If, Counter[str] | None]:
+    """count_loads of every if in func, each one counted from the ones nested in it,
+    so the arms of a long elif chain do not each walk everything below them"""
+    counted: dict[ast.If, Counter[str] | None] = {}
+    # ast.walk is breadth first, so reversed it reaches every if after the ones nested in it
+    for node in reversed([n for n in ast.walk(func) if isinstance(n, ast.If)]):
+        counted[node] = count_loads([node], counted)
+    return counted
+
+
+def always_returns(body: list[ast.stmt]) -> bool:
+    pending = [body]
+    while pending:
+        match pending.pop()[-1:]:
+            case [ast.Return()]:
+                pass
+            case [ast.If() as node]:
+                pending += [node.body, node.orelse]
+            case _:
+                return False
+    return True
+
+
+def returning_ifs(func: ast.FunctionDef) -> set[ast.If]:
+    """The ifs in func that return on both paths, found in one pass instead of asking always_returns at every level"""
+    returning: set[ast.If] = set()
+    # ast.walk is breadth first, so reversed it reaches every if after the ones nested in it
+    for node in reversed([n for n in ast.walk(func) if isinstance(n, ast.If)]):
+        if all(
+            arm and (isinstance(arm[-1], ast.Return) or arm[-1] in returning)
+            for arm in (node.body, node.orelse)
+        ):
+            returning.add(node)
+    return returning
+
+
+def with_implicit_return(body: list[ast.stmt]) -> list[ast.stmt]:
+    """Makes falling off the end of a void function an explicit return,
+    so that calls at the end of the function or of its if-arms are in tail position"""
+    result: list[ast.stmt] = []
+    # (an arm to rewrite, the list its rewritten statements go in)
+    pending = [(body, result)]
+    while pending:
+        body, out = pending.pop()
+        end = len(body)
+        while end > 0 and isinstance(body[end - 1], ast.Return):
+            if body[end - 1].value is not None:
+                break
+            end -= 1
+
+        if end == 0:
+            out.append(ast.Return())
+            continue
+
+        last = body[end - 1]
+        match last:
+            case ast.Return():
+                # already returns a value
+                tail = [last]
+            case ast.Expr(value=ast.Call()):
+                tail = [ast.Return(value=last.value)]
+            case ast.If():
+                rewritten = ast.If(test=last.test, body=[], orelse=[])
+                pending += [
+                    (last.body, rewritten.body),
+                    (last.orelse, rewritten.orelse),
+                ]
+                tail = [rewritten]
+            case _:
+                tail = [last, ast.Return()]
+
+        out += body[: end - 1] + [ast.copy_location(node, last) for node in tail]
+    return result
+
+
+# loops are lowered to helper functions nested where the loop was: a while becomes
+#
+#   def f__LOOP__0(<what the loop modifies>):
+#       if <test>:
+#           <body>
+#           return f__LOOP__0(<what the loop modifies>)
+#       else:
+#           <whatever follows the loop>
+#
+# everything the loop only reads is read from the enclosing frame, and the recursive call
+# is a tail call, so every iteration runs at the same stack depth (a tail call can only
+# carry two cells, loops that modify more are passed everything they read and take a frame
+# per iteration). When the loop is not followed by the end of the function (it is inside
+# an if that falls through, or inside another loop), what follows stays where it was and
+# the helper returns the (at most two) variables it modified that are read afterwards
+# instead. A for over a range is a while over a counter, or unrolled if it is short.
+#
+# An arm of an if only sees what it assigns itself, so an if (in a loop or not) whose arms
+# assign what follows it reads is moved into a helper of its own, which returns those (at
+# most two ints or one tuple) to be assigned after it. Loops cannot break or continue, or
+# have an else
+
+# in the name of every helper a loop or an assigning if is lowered to
+LOOP_HELPER = "__LOOP__"
+
+# unrolled range loops may grow their body to at most this many nodes
+UNROLL_MAX_NODES = 64
+
+
+def stored_names(node: ast.AST) -> list[str]:
+    """Names node binds, in the order ast.walk finds them, not counting the ones bound inside
+    the functions it defines"""
+    names: dict[str, None] = {}
+    pending = [node]
+    while pending:
+        current = pending.pop()
+        match current:
+            case ast.FunctionDef():
+                names[current.name] = None
+                continue
+            case ast.Name(ctx=ast.Store()):
+                names[current.id] = None
+        pending.extend(reversed(list(ast.iter_child_nodes(current))))
+    return list(names)
+
+
+def loaded_names(node: ast.AST) -> Counter[str]:
+    return Counter(
+        n.id
+        for n in ast.walk(node)
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)
+    )
+
+
+def literal_int(expr: ast.expr, constants: dict[str, ConstValue]) -> int | None:
+    match expr:
+        case ast.Constant(value=int(value)) if not isinstance(value, bool):
+            return value
+        case ast.UnaryOp(op=ast.USub(), operand=ast.Constant(value=int(value))):
+            return -value
+        case ast.Name(id=name) if isinstance(constants.get(name), int):
+            return constants[name]
+    return None
+
+
+def inferred_type(
+    value: ast.expr, types: dict[str, str], returns: dict[str, ast.expr | None]
+) -> str:
+    """int or tuple, whichever value looks like it evaluates to"""
+    match value:
+        case ast.Tuple():
+            return "tuple"
+        case ast.Name(id=name):
+            return types.get(name, "int")
+        case ast.Call(func=ast.Name(id=name)) if isinstance(
+            returns.get(name), ast.Name
+        ):
+            return returns[name].id
+    return "int"
+
+
+class LoopLowering:
+    """Rewrites the while and for-range loops of a top-level function (and of the functions
+    nested in it) into helper functions, and the ifs whose arms assign what follows them,
+    see above. Augmented assignments to names are spelled out on the way, loops tend to be
+    full of them"""
+
+    def __init__(
+        self,
+        func: ast.FunctionDef,
+        returns: dict[str, ast.expr | None],
+        options: CompilerOptions,
+    ):
+        self.func = func
+        self.unroll_limit = options.unroll_limit
+        self.tail_calls = options.tail_calls
+        self.helpers = 0
+        self.loads = loaded_names(func)
+        self.constants = single_constant_assignments(func)
+
+        # reads of names outside the range loops over them, which assign them before reading
+        self.unlooped_loads: Counter[str] = Counter()
+        pending: list[tuple[ast.AST, frozenset[str]]] = [(func, frozenset())]
+        while pending:
+            node, targets = pending.pop()
+            match node:
+                case ast.For(target=ast.Name(id=name)):
+                    targets = targets | {name}
+                case ast.Name(ctx=ast.Load()) if node.id not in targets:
+                    self.unlooped_loads[node.id] += 1
+            pending += [(child, targets) for child in ast.iter_child_nodes(node)]
+
+        self.returns = dict(returns)
+        self.types: dict[str, str] = {}
+        for node in ast.walk(func):
+            match node:
+                case ast.FunctionDef():
+                    self.returns[node.name] = node.returns
+                    for arg in node.args.args:
+                        if isinstance(arg.annotation, ast.Name):
+                            self.types[arg.arg] = arg.annotation.id
+        for node in ast.walk(func):
+            if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+                self.types[node.targets[0].id] = inferred_type(
+                    node.value, self.types, self.returns
+                )
+
+    def lower(self) -> ast.FunctionDef:
+        lowered = self.copy_def(self.func)
+        # (statements to lower, the list they go in, names bound before them, whether the end
+        # of the statements is the end of the function, the names bound before the loop they
+        # are the body of if they are, and the return annotation of the function they are in)
+        pending = [
+            (
+                self.func.body,
+                lowered.body,
+                {arg.arg for arg in self.func.args.args},
+                True,
+                None,
+                self.func.returns,
+            )
+        ]
+        while pending:
+            stmts, out, bound, tail, loop_bound, returns = pending.pop()
+            stmts = list(stmts)
+            bound = set(bound)
+            i = 0
+            while i < len(stmts):
+                stmt = stmts[i]
+                i += 1
+                match stmt:
+                    case ast.AugAssign(target=ast.Name(id=name)):
+                        assign = ast.Assign(
+                            targets=[stmt.target],
+                            value=self.located(
+                                ast.BinOp(
+                                    left=ast.Name(id=name, ctx=ast.Load()),
+                                    op=stmt.op,
+                                    right=stmt.value,
+                                ),
+                                stmt,
+                            ),
+                        )
+                        out.append(ast.copy_location(assign, stmt))
+                        bound.add(name)
+                    case ast.If() if live := self.assigned_for(stmt, stmts[i:]):
+                        helper, arms, replacement = self.lower_assigning_if(stmt, live)
+                        pending.append(
+                            (arms, helper.body, bound, True, loop_bound, helper.returns)
+                        )
+                        out += [helper, *replacement]
+                        bound.update(stored_names(stmt))
+                    case ast.If():
+                        copied = ast.copy_location(
+                            ast.If(test=stmt.test, body=[], orelse=[]), stmt
+                        )
+                        arms = [stmt.body, stmt.orelse]
+                        returning = [always_returns(arm) for arm in arms]
+                        if i < len(stmts) and returning[0] != returning[1]:
+                            # what follows only runs after the arm that does not return,
+                            # so it goes at the end of it (loops tend to return like this)
+                            arms[returning[0]] = arms[returning[0]] + stmts[i:]
+                            i = len(stmts)
+                        for arm, lowered_arm in zip(arms, (copied.body, copied.orelse)):
+                            # the arm ends the function if it returns, or if the if does
+                            arm_tail = always_returns(arm) or (tail and i == len(stmts))
+                            pending.append(
+                                (arm, lowered_arm, bound, arm_tail, loop_bound, returns)
+                            )
+                        out.append(copied)
+                        bound.update(stored_names(stmt))
+                    case ast.FunctionDef():
+                        copied = self.copy_def(stmt)
+                        args = {arg.arg for arg in stmt.args.args}
+                        pending.append(
+                            (
+                                stmt.body,
+                                copied.body,
+                                bound | args,
+                                True,
+                                None,
+                                stmt.returns,
+                            )
+                        )
+                        out.append(copied)
+                        bound.add(stmt.name)
+                    case ast.For():
+                        # run whatever the loop turns into next
+                        stmts[i - 1 : i] = self.lower_for(stmt, bound)
+                        i -= 1
+                    case ast.While():
+                        assert not stmt.orelse, generate_error_message(
+                            "while loops cannot have an else", stmt
+                        )
+                        rest = stmts[i:] if tail else None
+                        lowered_loop, body, exit = self.lower_while(
+                            stmt, bound, loop_bound, returns, rest
+                        )
+                        out += lowered_loop
+                        helper = lowered_loop[0]
+                        pending.append(
+                            (
+                                body,
+                                helper.body[0].body,
+                                bound,
+                                False,
+                                bound,
+                                helper.returns,
+                            )
+                        )
+                        if rest is not None:
+                            pending.append(
+                                (
+                                    rest,
+                                    helper.body[0].orelse,
+                                    bound,
+                                    True,
+                                    None,
+                                    returns,
+                                )
+                            )
+                            break
+                        helper.body[0].orelse += exit
+                    case _:
+                        out.append(stmt)
+                        bound.update(stored_names(stmt))
+        return lowered
+
+    def lower_while(
+        self,
+        loop: ast.While,
+        bound: set[str],
+        loop_bound: set[str] | None,
+        returns: ast.expr | None,
+        rest: list[ast.stmt] | None,
+    ) -> tuple[list[ast.stmt], list[ast.stmt], list[ast.stmt]]:
+        """The statements the loop is replaced with (the helper first), the body of the helper's
+        loop arm and, unless rest is given to take its place, its exit arm"""
+        name = f"{self.func.name}{LOOP_HELPER}{self.helpers}"
+        self.helpers += 1
+
+        inside = loaded_names(loop)
+
+        def read_after(var: str) -> bool:
+            # in a loop, the next run of this one reads whatever the enclosing loop carries
+            return self.loads[var] > inside[var] or (
+                loop_bound is not None and var in loop_bound and inside[var] > 0
+            )
+
+        # the loop state: whatever it modifies that was there before it and is read at all
+        carried = [
+            var
+            for var in stored_names(loop)
+            if var in bound and (inside[var] or read_after(var))
+        ]
+        # everything else it reads, it reads from our frame. That only works if it recurses
+        # with a tail call, which can slide at most two cells down over the frame it replaces,
+        # otherwise every iteration takes a frame and it has to be passed all it reads
+        params = list(carried)
+        cells = sum(2 if self.types.get(var) == "tuple" else 1 for var in carried)
+        if not self.tail_calls or not 0 < cells <= 2:
+            reads = inside + loaded_names(ast.Module(body=rest or [], type_ignores=[]))
+            params += [
+                var
+                for var in reads
+                if var in bound and var not in carried and var not in self.returns
+            ]
+            log.warning(
+                "%s: the loop at line %d cannot run in constant stack depth",
+                self.func.name,
+                loop.lineno,
+            )
+
+        def call_helper() -> ast.Call:
+            args = [ast.Name(id=var, ctx=ast.Load()) for var in params]
+            return self.located(
+                ast.Call(
+                    func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[]
+                ),
+                loop,
+            )
+
+        body = list(loop.body)
+        if rest is not None:
+            # what follows the loop runs in the helper, and returns for the whole function
+            helper_returns = returns
+            if not always_returns(body):
+                body.append(self.located(ast.Return(value=call_helper()), loop))
+            replacement: list[ast.stmt] = [
+                self.located(ast.Return(value=call_helper()), loop)
+            ]
+            exit: list[ast.stmt] = []
+        else:
+            assert not any(isinstance(node, ast.Return) for node in ast.walk(loop)), (
+                generate_error_message(
+                    "only a loop that ends the function can return from it", loop
+                )
+            )
+            body.append(self.located(ast.Return(value=call_helper()), loop))
+            live = [var for var in carried if read_after(var)]
+            assert len(live) <= 2, generate_error_message(
+                f"a loop inside an if or another loop can leave at most two variables "
+                f"for what follows it, this one leaves {', '.join(live)}",
+                loop,
+            )
+            assert len(live) < 2 or all(
+                self.types.get(v, "int") == "int" for v in live
+            ), generate_error_message(
+                "a loop can only leave a tuple for what follows it on its own", loop
+            )
+            helper_returns, exit, replacement = self.handed_back(
+                live, name, call_helper(), loop
+            )
+
+        helper = self.helper_def(name, params, helper_returns, loop)
+        helper.body.append(ast.If(test=loop.test, body=[], orelse=[]))
+        return [helper, *replacement], body, exit
+
+    def assigned_for(self, node: ast.If, rest: list[ast.stmt]) -> list[str]:
+        """What the arms of an if assign that rest, which follows it in the same block (the
+        next iteration included, in the body of a loop), reads. An arm only sees what it assigns itself, so these have to be handed
+        back out of the arms (unless one of them returns, then rest moves into the other one)"""
+        if any(always_returns(arm) for arm in (node.body, node.orelse)):
+            return []
+        reads = loaded_names(ast.Module(body=rest, type_ignores=[]))
+        return [var for var in stored_names(node) if reads[var]]
+
+    def lower_assigning_if(
+        self, node: ast.If, live: list[str]
+    ) -> tuple[ast.FunctionDef, list[ast.stmt], list[ast.stmt]]:
+        """A helper the if is moved into, which returns what its arms assign to whatever reads
+        it after the if, the statements to lower into the helper and the ones that call it"""
+        assert not any(isinstance(n, ast.Return) for n in ast.walk(node)), (
+            generate_error_message(
+                "an if cannot return from only some of its paths when its arms "
+                f"assign {', '.join(live)}, which is read after it",
+                node,
+            )
+        )
+        assert len(live) <= 2, generate_error_message(
+            f"an if can assign at most two variables that are read after it, "
+            f"this one assigns {', '.join(live)}",
+            node,
+        )
+        assert len(live) < 2 or all(self.types.get(v, "int") == "int" for v in live), (
+            generate_error_message(
+                "an if can only assign a tuple read after it on its own", node
+            )
+        )
+        name = f"{self.func.name}{LOOP_HELPER}{self.helpers}"
+        self.helpers += 1
+
+        call = ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=[], keywords=[])
+        helper_returns, exit, replacement = self.handed_back(
+            live, name, self.located(call, node), node
+        )
+        # both arms end in the return now, which reads what they assigned
+        arms = [node.body + exit, node.orelse + copy.deepcopy(exit)]
+        self.loads.update(loaded_names(ast.Module(body=exit * 2, type_ignores=[])))
+        lowered = ast.If(test=node.test, body=arms[0], orelse=arms[1])
+        helper = self.helper_def(name, [], helper_returns, node)
+        return helper, [ast.copy_location(lowered, node)], replacement
+
+    def handed_back(
+        self, live: list[str], name: str, call: ast.Call, at: ast.stmt
+    ) -> tuple[ast.expr, list[ast.stmt], list[ast.stmt]]:
+        """The return annotation of the helper called by call, the return that hands live back
+        out of it and the statements that call it and assign live from what it returned"""
+        match live:
+            case []:
+                helper_returns = ast.Constant(value=None)
+                exit = [ast.Return()]
+                replacement = [ast.Expr(value=call)]
+            case [var]:
+                helper_returns = ast.Name(id=self.types.get(var, "int"), ctx=ast.Load())
+                exit = [ast.Return(value=ast.Name(id=var, ctx=ast.Load()))]
+                replacement = [
+                    ast.Assign(
+                        targets=[ast.Name(id=var, ctx=ast.Store())],
+                        value=call,
+                    )
+                ]
+            case [first, second]:
+                helper_returns = ast.Name(id="tuple", ctx=ast.Load())
+                exit = [
+                    ast.Return(
+                        value=ast.Tuple(
+                            elts=[ast.Name(id=v, ctx=ast.Load()) for v in live],
+                            ctx=ast.Load(),
+                        )
+                    )
+                ]
+                state = f"{name}__state"
+                replacement = [
+                    ast.Assign(
+                        targets=[ast.Name(id=state, ctx=ast.Store())],
+                        value=call,
+                    )
+                ] + [
+                    ast.Assign(
+                        targets=[ast.Name(id=var, ctx=ast.Store())],
+                        value=ast.Subscript(
+                            value=ast.Name(id=state, ctx=ast.Load()),
+                            slice=ast.Constant(value=index),
+                            ctx=ast.Load(),
+                        ),
+                    )
+                    for index, var in enumerate((first, second))
+                ]
+        exit = [self.located(stmt, at) for stmt in exit]
+        replacement = [self.located(stmt, at) for stmt in replacement]
+        return helper_returns, exit, replacement
+
+    def helper_def(
+        self, name: str, params: list[str], returns: ast.expr, at: ast.stmt
+    ) -> ast.FunctionDef:
+        helper = ast.FunctionDef(
+            name=name,
+            args=ast.arguments(
+                posonlyargs=[],
+                args=[
+                    ast.arg(
+                        arg=var,
+                        annotation=ast.Name(
+                            id=self.types.get(var, "int"), ctx=ast.Load()
+                        ),
+                    )
+                    for var in params
+                ],
+                kwonlyargs=[],
+                kw_defaults=[],
+                defaults=[],
+            ),
+            body=[],
+            decorator_list=[],
+            returns=returns,
+            type_params=[],
+        )
+        return self.located(helper, at)
+
+    def lower_for(self, loop: ast.For, bound: set[str]) -> list[ast.stmt]:
+        """The loop as a while loop, or unrolled"""
+        match loop:
+            case ast.For(
+                target=ast.Name(id=var),
+                iter=ast.Call(func=ast.Name(id="range"), args=args, keywords=[]),
+                orelse=[],
+            ) if 1 <= len(args) <= 3:
+                pass
+            case _:
+                raise Exception(
+                    generate_error_message(
+                        "only `for <name> in range(...)` loops without an else are supported",
+                        loop,
+                    )
+                )
+
+        start = args[0] if len(args) > 1 else ast.Constant(value=0)
+        stop = args[1] if len(args) > 1 else args[0]
+        step = literal_int(args[2], {}) if len(args) > 2 else 1
+        assert step, generate_error_message(
+            "the step of a range must be a nonzero constant", loop
+        )
+
+        body_stores = {name for stmt in loop.body for name in stored_names(stmt)}
+        read_after = self.unlooped_loads[var] > 0
+
+        first, last = (
+            literal_int(start, self.constants),
+            literal_int(stop, self.constants),
+        )
+        if first is not None and last is not None:
+            values = range(first, last, step)
+            size = sum(1 for stmt in loop.body for _ in ast.walk(stmt))
+            if (
+                len(values) <= self.unroll_limit
+                and len(values) * size <= UNROLL_MAX_NODES
+                and not any(
+                    isinstance(node, (ast.FunctionDef, ast.Return))
+                    for stmt in loop.body
+                    for node in ast.walk(stmt)
+                )
+            ):
+                unrolled = self.unrolled(
+                    loop, var, values, var in body_stores, read_after
+                )
+                # the copies are read like the loop never was
+                self.loads.subtract(loaded_names(loop))
+                for stmt in unrolled:
+                    self.loads.update(loaded_names(stmt))
+                return unrolled
+
+        # the body cannot change how many times the loop runs, so the range gets a counter
+        # of its own unless nothing but the loop reads the variable
+        counter = var
+        if var in body_stores or read_after:
+            counter = f"{self.func.name}__RANGE__{self.helpers}"
+        prelude: list[ast.stmt] = []
+        if not (
+            literal_int(stop, {}) is not None
+            or isinstance(stop, ast.Name)
+            and stop.id not in body_stores
+            and stop.id != var
+        ):
+            bound = f"{self.func.name}__STOP__{self.helpers}"
+            prelude.append(
+                ast.Assign(targets=[ast.Name(id=bound, ctx=ast.Store())], value=stop)
+            )
+            stop = ast.Name(id=bound, ctx=ast.Load())
+        prelude.append(
+            ast.Assign(targets=[ast.Name(id=counter, ctx=ast.Store())], value=start)
+        )
+        if counter != var and read_after and var not in bound:
+            # so it is there after the loop, like python leaves it (an empty range leaves
+            # what was bound before alone)
+            prelude.append(
+                ast.Assign(
+                    targets=[ast.Name(id=var, ctx=ast.Store())],
+                    value=ast.Name(id=counter, ctx=ast.Load()),
+                )
+            )
+
+        index = ast.Name(id=counter, ctx=ast.Load())
+        test = ast.Compare(
+            left=index if step > 0 else stop,
+            ops=[ast.Lt()],
+            comparators=[stop if step > 0 else index],
+        )
+        body = list(loop.body)
+        if counter != var:
+            body.insert(
+                0,
+                ast.Assign(
+                    targets=[ast.Name(id=var, ctx=ast.Store())],
+                    value=ast.Name(id=counter, ctx=ast.Load()),
+                ),
+            )
+        body.append(
+            ast.Assign(
+                targets=[ast.Name(id=counter, ctx=ast.Store())],
+                value=ast.BinOp(
+                    left=ast.Name(id=counter, ctx=ast.Load()),
+                    op=ast.Add(),
+                    right=ast.Constant(value=step),
+                ),
+            )
+        )
+        body = [
+            stmt if stmt in loop.body else self.located(stmt, loop) for stmt in body
+        ]
+        while_loop = ast.While(test=self.located(test, loop), body=body, orelse=[])
+        return [self.located(stmt, loop) for stmt in prelude] + [
+            ast.copy_location(while_loop, loop)
+        ]
+
+    def unrolled(
+        self, loop: ast.For, var: str, values: range, assigned: bool, read_after: bool
+    ) -> list[ast.stmt]:
+        unrolled: list[ast.stmt] = []
+        for value in values:
+            constant = ast.Constant(value=value)
+            if assigned:
+                assign = ast.Assign(
+                    targets=[ast.Name(id=var, ctx=ast.Store())], value=constant
+                )
+                unrolled.append(self.located(assign, loop))
+                unrolled += copy.deepcopy(loop.body)
+            else:
+                substituter = ConstantSubstituter({var: value})
+                unrolled += [
+                    run_steps(substituter.generic_visit(copy.deepcopy(stmt)))
+                    for stmt in loop.body
+                ]
+        if values and read_after and not assigned:
+            assign = ast.Assign(
+                targets=[ast.Name(id=var, ctx=ast.Store())],
+                value=ast.Constant(value=values[-1]),
+            )
+            unrolled.append(self.located(assign, loop))
+        return unrolled
+
+    def copy_def(self, func: ast.FunctionDef) -> ast.FunctionDef:
+        copied = ast.FunctionDef(
+            name=func.name,
+            args=func.args,
+            body=[],
+            decorator_list=func.decorator_list,
+            returns=func.returns,
+            type_params=getattr(func, "type_params", []),
+        )
+        return ast.copy_location(copied, func)
+
+    @staticmethod
+    def located(node: ast.AST, at: ast.AST) -> ast.AST:
+        # nodes made up for a loop sit where the loop does, the ones taken from it stay put
+        for current in ast.walk(node):
+            if not hasattr(current, "lineno") and "lineno" in current._attributes:
+                ast.copy_location(current, at)
+        return node
+
+
+def lower_loops(
+    func: ast.FunctionDef,
+    returns: dict[str, ast.expr | None],
+    options: CompilerOptions,
+) -> ast.FunctionDef:
+    """func with its loops (and assigning ifs) lowered to helper functions, func itself if it
+    has none. returns holds the return annotation of every top-level function"""
+    lowered = False
+    for node in ast.walk(func):
+        assert not isinstance(node, (ast.Break, ast.Continue)), generate_error_message(
+            "loops cannot break or continue", node
+        )
+        lowered = (
+            lowered
+            or isinstance(node, (ast.While, ast.For, ast.AugAssign))
+            or isinstance(node, ast.If)
+            and any(stored_names(stmt) for stmt in node.body + node.orelse)
+        )
+    if not lowered:
+        return func
+    return LoopLowering(func, returns, options).lower()
+
+
 # ClacCompile should be created for all FunctionDef
 class FunctionCompiler(ast.NodeVisitor):
     # given a FunctionDef, and names, the function compiler should be able to compile this function and all of it's children
-    def __init__(self, fun: ast.FunctionDef, names: dict[str, ClacValue], stack_size=0):
+    def __init__(
+        self,
+        fun: ast.FunctionDef,
+        names: Scope,
+        stack_size=0,
+        enclosing: "FunctionCompiler | None" = None,
+        returns_from_enclosing=False,
+        options: CompilerOptions | None = None,
+    ):
+        # enclosing is set for if-arms, which run inside the frame of the function they were written in
+        options = options or CompilerOptions()
         self.func: ast.FunctionDef = fun
+        self.enclosing = enclosing
+        self.options = options
+        # the python function arms were written in, for telling where a definition came from
+        self.python_function = (
+            fun.name if enclosing is None else enclosing.python_function
+        )
+        # spans of the nodes being compiled, innermost last (None without source maps). an
+        # arm starts out at the if it belongs to
+        self.locations: list[Span] | None = None
+        if options.source_map:
+            self.locations = [
+                (fun.lineno, fun.col_offset)
+                if enclosing is None
+                else enclosing.locations[-1]
+            ]
 
         self.if_counter = 0
 
@@ -204,9 +2715,28 @@ class FunctionCompiler(ast.NodeVisitor):
         self.stack_size = stack_size
         # stack_size should be the size of parent stack + # args (assume that the caller always puts those args onto the parent stack)
 
+        # everything above frame_base belongs to this function
+        self.frame_base = stack_size if enclosing is None else enclosing.frame_base
+        # a return statement cleans the stack down to return_base (arms of an if that
+        # returns on both paths return straight out of the enclosing function)
+        self.return_base = (
+            enclosing.return_base if returns_from_enclosing else stack_size
+        )
+        # reading a position at or below frame_base means we capture a parent local
+        self.lowest_reference = self.frame_base + 1
+
         # we have access to whatever was in our parent function, as well as our local variables
         self.names = names
 
+        # which of our own variables lives in each of our slots, None once it has been reassigned
+        # (arms that return out of the enclosing function own its whole frame)
+        self.slot_owner: dict[int, str | None] = (
+            dict(enclosing.slot_owner) if returns_from_enclosing else {}
+        )
+        self.owned_base = enclosing.owned_base if returns_from_enclosing else stack_size
+        # slots that were moved out of the frame into an expression
+        self.consumed = 0
+
         # assume that caller put these args on the stack in the correct order
         for arg in args:
             assert arg.annotation, (
@@ -220,9 +2750,12 @@ class FunctionCompiler(ast.NodeVisitor):
                 case "int":
                     self.stack_size += 1
                     self.names[arg.arg] = ClacInt(self.stack_size)
+                    self.slot_owner[self.stack_size] = arg.arg
                 case "tuple":
                     self.stack_size += 2
                     self.names[arg.arg] = PyTuple(self.stack_size - 1)
+                    self.slot_owner[self.stack_size - 1] = arg.arg
+                    self.slot_owner[self.stack_size] = arg.arg
                 case _:
                     raise Exception(
                         f"Unknown Type! Expecting int or tuple | Line {arg.lineno}"
@@ -254,31 +2787,104 @@ class FunctionCompiler(ast.NodeVisitor):
                 raise Exception()
 
         self.names[self.func.name] = ClacFunc(
-            self.func.name, self.argument_size_resolved, return_size, [], []
+            self.func.name,
+            self.argument_size_resolved,
+            return_size,
+            Code(),
+            [],
+            captures=self.frame_base > 0,
         )
 
-        self.queue: list[OpCode] = []
-        self.children_functions: list[ClacFunc] = []
+        if enclosing is None:
+            self.function_record = self.names[self.func.name]
+            self.void = return_size == 0
+            if self.void:
+                self.func = ast.copy_location(
+                    ast.FunctionDef(
+                        name=fun.name,
+                        args=fun.args,
+                        body=with_implicit_return(fun.body),
+                        returns=fun.returns,
+                    ),
+                    fun,
+                )
+        else:
+            self.function_record = enclosing.function_record
+            self.void = enclosing.void
+
+        # worked out once for the whole function, every arm looks its ifs up in them
+        if enclosing is None:
+            self.returning = returning_ifs(self.func)
+            self.if_loads = count_if_loads(self.func) if options.liveness else {}
+        else:
+            self.returning = enclosing.returning
+            self.if_loads = enclosing.if_loads
 
-        print(f"Function Compiler initialized: {self.stack_size} stack size")
+        # reads left of each name, a variable is dead after its last one
+        self.loads_left = (
+            count_loads(self.func.body, self.if_loads) if options.liveness else None
+        )
+
+        self.queue = Code() if self.locations is None else MappedCode()
+        self.children_functions: list[ClacFunc] = []
+        # what the loop helpers defined here that have not been called yet read, each counted
+        # as one load until they are
+        self.helper_reads: dict[str, set[str]] = {}
+
+        log.debug("compiling %s at stack size %d", self.func.name, self.stack_size)
+
+    # visit_ methods are steps (see run_steps), the ones that compile something below
+    # them yield it: `yield self.visit(node)`, `t = yield self.eval_expression_and_get_type(e)`
+    def visit(self, node: ast.AST) -> Steps:
+        if self.locations is None or not hasattr(node, "lineno"):
+            return visit_steps(self, node)
+        return self.located_steps(node)
+
+    def located_steps(self, node: ast.AST) -> Steps:
+        # whatever is queued while node compiles came from it, unless a node below it is closer
+        self.locations.append((node.lineno, node.col_offset))
+        try:
+            return (yield visit_steps(self, node))
+        finally:
+            self.locations.pop()
+
+    def generic_visit(self, node: ast.AST) -> Steps:
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        yield self.visit(item)
+            elif isinstance(value, ast.AST):
+                yield self.visit(value)
 
     def visit_arguments(self, node: ast.arguments):
-        print("Already visited args in function def")
+        log.debug("arguments of %s were read with the function", self.func.name)
 
     def add_opcode_to_queue(self, opcode: OpCode):
         # print(f"adding {opcode} | delta: {opcode.stack_delta()}")
-        self.queue.append(opcode)
+        if self.locations is None:
+            self.queue.append(opcode)
+        else:
+            self.queue.append(opcode, self.locations[-1])
         self.stack_size += opcode.stack_delta()
 
-    def eval_expression_and_get_type(self, expr: ast.expr) -> type[ClacValue]:
+    def eval_expression_and_get_type(self, expr: ast.expr) -> Steps:
+        """Steps that compile expr, they return its type"""
         old_size = self.stack_size
-        self.visit(expr)
-        expr_size: int = self.stack_size - old_size
+        old_consumed = self.consumed
+        yield self.visit(expr)
+        # variables moved into the expression were already on the stack
+        expr_size: int = self.stack_size - old_size + self.consumed - old_consumed
 
         assert 0 <= expr_size <= 2, generate_error_message(
             f"0 <= expression_size <= 2 must hold for expr={expr}", expr
         )
-        print(f"Evaluated {expr} -> {expr_size}")
+        log.debug(
+            "evaluated %s at line %d -> %d",
+            type(expr).__name__,
+            getattr(expr, "lineno", 0),
+            expr_size,
+        )
 
         match expr_size:
             case 0:
@@ -290,21 +2896,106 @@ class FunctionCompiler(ast.NodeVisitor):
             case _:
                 raise Exception(generate_error_message("Unknown expresion type", expr))
 
-    def func_visit(self, node: ast.FunctionDef):
+    def func_visit(self, node: ast.FunctionDef) -> Steps:
         """Called if no explicit visitor function exists for a node."""
         for field, value in ast.iter_fields(node):
             if field == "returns":
                 continue
 
             if isinstance(value, list):
+                if field == "body":
+                    self.drop_dead_slots()
                 for item in value:
                     if isinstance(item, ast.AST):
-                        self.visit(item)
+                        yield self.visit(item)
+                        if field == "body":
+                            self.drop_dead_slots()
             elif isinstance(value, ast.AST):
-                self.visit(value)
+                yield self.visit(value)
+
+    def is_dead(self, position: int) -> bool:
+        if self.loads_left is None or position not in self.slot_owner:
+            return False
+        owner = self.slot_owner[position]
+        return owner is None or self.loads_left[owner] == 0
+
+    def remove_slot(self, position: int):
+        # everything above position slides down by one
+        moved: set[str] = set()
+        slot_owner: dict[int, str | None] = {}
+        for slot, owner in self.slot_owner.items():
+            if slot < position:
+                slot_owner[slot] = owner
+            elif slot > position:
+                slot_owner[slot - 1] = owner
+                if owner is not None:
+                    moved.add(owner)
+        self.slot_owner = slot_owner
+
+        for owner in moved:
+            first = min(slot for slot, name in slot_owner.items() if name == owner)
+            self.names[owner] = type(self.names[owner])(first)
+
+    def forget_slots_above(self, position: int):
+        self.slot_owner = {
+            slot: owner for slot, owner in self.slot_owner.items() if slot <= position
+        }
+
+    def drop_dead_slots(self):
+        # drop, swap drop and rot drop can reach a dead slot in the top three cells
+        depth = 1
+        while depth <= 3:
+            position = self.stack_size - depth + 1
+            if position <= self.owned_base:
+                return
+            if not self.is_dead(position):
+                depth += 1
+                continue
+
+            match depth:
+                case 2:
+                    self.add_opcode_to_queue(Swap())
+                case 3:
+                    self.add_opcode_to_queue(Rot())
+            self.add_opcode_to_queue(Drop())
+            self.remove_slot(position)
+            depth = 1
+
+    def load_by_moving(self, name: str, val: ClacInt | PyTuple) -> bool:
+        """Moves the variable to the top of the stack instead of copying it, if this was its last read
+        and that is cheaper than a pick"""
+        if self.loads_left is None:
+            return False
+
+        self.loads_left[name] -= 1
+        if self.loads_left[name] > 0 or self.slot_owner.get(val.position) != name:
+            return False
+
+        depth = self.stack_size - val.position + 1
+        match val, depth:
+            case ClacInt(), 1:
+                pass
+            case ClacInt(), 2:
+                self.add_opcode_to_queue(Swap())
+            case ClacInt(), 3:
+                self.add_opcode_to_queue(Rot())
+            case PyTuple(), 2:
+                # both halves are already on top, in order
+                self.remove_slot(val.position + 1)
+                self.consumed += 1
+            case _:
+                return False
+
+        self.remove_slot(val.position)
+        self.consumed += 1
+        del self.names[name]
+        return True
 
     def compile(self) -> ClacFunc:
-        self.func_visit(self.func)
+        return run_steps(self.compile_steps())
+
+    def compile_steps(self) -> Steps:
+        yield self.func_visit(self.func)
         # print(f"{self.func.name}-> final names:", self.names)
         return ClacFunc(
             self.func.name,
@@ -312,6 +3003,18 @@ class FunctionCompiler(ast.NodeVisitor):
             self.stack_size - self.parent_stack_size,
             self.queue,
             self.children_functions,
+            captures=self.lowest_reference <= self.frame_base,
+            inlinable=self.lowest_reference > self.frame_base,
+            own_frame=self.enclosing is None
+            and self.lowest_reference > self.frame_base,
+            origin=(
+                self.python_function,
+                getattr(
+                    self.func if self.enclosing is None else self.func.body[0],
+                    "lineno",
+                    0,
+                ),
+            ),
         )
 
     def visit_Constant(self, node: ast.Constant):
@@ -322,49 +3025,114 @@ class FunctionCompiler(ast.NodeVisitor):
         self.add_opcode_to_queue(Push(node.value))
 
     def visit_FunctionDef(self, node: ast.FunctionDef):
-        print(f"visiting with stack size: {self.stack_size}")
+        log.debug("nested function %s at stack size %d", node.name, self.stack_size)
         # FIXME: children functions cannot use parent locals correctly if stack gets misaligned between compilation and call (like if something else gets pushed onto the stack)
 
-        # node.name
-        compiler = FunctionCompiler(node, self.names.copy(), self.stack_size)
-        res = compiler.compile()
+        # the function reads our frame where it is now, dead slots go before that
+        self.drop_dead_slots()
+        compiler = FunctionCompiler(
+            node, self.names.child(), self.stack_size, options=self.options
+        )
+        res = yield compiler.compile_steps()
         local_name = res.name
+        self.lowest_reference = min(self.lowest_reference, compiler.lowest_reference)
 
         # FIXME: hoisting can lead to namespacing issues, this fix doesn't work if the hoisted function calls itself recursively
         # res.name = f"{self.func.name}__{local_name}"
 
-        print(f"Compiled child: {res}")
+        log.debug("compiled nested function %s", res.name)
+        if self.loads_left is not None and LOOP_HELPER in node.name:
+            self.helper_reads[res.name] = set(count_loads(node.body, self.if_loads))
         self.children_functions.append(res)
         self.names[local_name] = res
 
-    def visit_ReturnWithKnownDataAlreadyOnStack(self, returnType: type[ClacValue]):
-        print("!!!!!!! return:", self.func)
+    def visit_ReturnWithKnownDataAlreadyOnStack(
+        self, returnType: type[ClacValue], base: int | None = None
+    ):
+        """Cleans the stack down to base (return_base unless given), keeping the value on top"""
+        log.debug("return from %s", self.func.name)
+        if base is None:
+            base = self.return_base
         match returnType:
             case cls if cls is ClacVoid:
-                while self.stack_size > self.parent_stack_size:
+                while self.stack_size > base:
                     self.add_opcode_to_queue(Drop())
 
             case cls if cls is ClacInt:
-                while self.stack_size > self.parent_stack_size + 1:
+                while self.stack_size > base + 1:
                     self.add_opcode_to_queue(Swap())
                     self.add_opcode_to_queue(Drop())
 
             case cls if cls is PyTuple:
-                while self.stack_size > self.parent_stack_size + 2:
+                while self.stack_size > base + 2:
                     self.add_opcode_to_queue(Rot())
                     self.add_opcode_to_queue(Drop())
             case _:
                 raise Exception()
 
+        self.forget_slots_above(base)
+
     def visit_Return(self, node: ast.Return):
+        if self.options.tail_calls and isinstance(node.value, ast.Call):
+            if (yield self.visit_TailCall(node.value)):
+                return
+
         # visit all of this node's children
         if node.value is None:
             expr_type: type[ClacValue] = ClacVoid
         else:
-            expr_type: type[ClacValue] = self.eval_expression_and_get_type(node.value)
+            expr_type = yield self.eval_expression_and_get_type(node.value)
+
+        if self.void:
+            # whatever was computed is discarded along with the frame
+            expr_type = ClacVoid
 
         self.visit_ReturnWithKnownDataAlreadyOnStack(expr_type)
 
+    def visit_TailCall(self, node: ast.Call) -> Steps:
+        """Steps that return whether node could be compiled as a tail call"""
+        # slides the arguments down over our frame before calling, so nothing is
+        # left to clean up afterwards and recursive loops run in constant stack depth
+        assert isinstance(node.func, ast.Name)
+        to_call = self.names.get(node.func.id)
+        if not isinstance(to_call, ClacFunc):
+            return False
+
+        # the callee would read from the frame we are about to drop
+        if to_call.captures and to_call is not self.function_record:
+            return False
+
+        if self.void and to_call.ret_count != 0:
+            return False
+
+        # swap and rot only reach the top three cells, so at most one int or one tuple fits
+        # (recursion with more argument cells keeps a frame per call, as update in
+        # cases/integrate does)
+        if to_call.arg_count > 2:
+            return False
+
+        if self.stack_size == self.return_base:
+            return False
+
+        yield self.generic_visit(node)
+
+        # loading the arguments may have moved some of the frame into them already
+        frame_size = self.stack_size - self.return_base - to_call.arg_count
+        for _ in range(frame_size):
+            match to_call.arg_count:
+                case 0:
+                    self.add_opcode_to_queue(Drop())
+                case 1:
+                    self.add_opcode_to_queue(Swap())
+                    self.add_opcode_to_queue(Drop())
+                case 2:
+                    self.add_opcode_to_queue(Rot())
+                    self.add_opcode_to_queue(Drop())
+
+        self.forget_slots_above(self.return_base)
+        self.add_call_to_queue(to_call)
+        return True
+
     def visit_Assign(self, node: ast.Assign):
         assert len(node.targets) == 1, generate_error_message(
             "Can only assign to one variable", node
@@ -374,15 +3142,24 @@ class FunctionCompiler(ast.NodeVisitor):
             "Must assign to name", node
         )
 
-        expr_type = self.eval_expression_and_get_type(node.value)
-        print(f"{name.id} :: {expr_type}")
+        expr_type = yield self.eval_expression_and_get_type(node.value)
+        log.debug("%s :: %s", name.id, expr_type.__name__)
+
+        # whatever the name held before is unreachable now
+        for slot, owner in self.slot_owner.items():
+            if owner == name.id:
+                self.slot_owner[slot] = None
+
         match expr_type:
             case cls if cls is ClacVoid:
                 raise Exception()
             case cls if cls is ClacInt:
                 self.names[name.id] = ClacInt(self.stack_size)
+                self.slot_owner[self.stack_size] = name.id
             case cls if cls is PyTuple:
                 self.names[name.id] = PyTuple(self.stack_size - 1)
+                self.slot_owner[self.stack_size - 1] = name.id
+                self.slot_owner[self.stack_size] = name.id
             case _:
                 raise Exception()
 
@@ -392,7 +3169,7 @@ class FunctionCompiler(ast.NodeVisitor):
         )
         # we should load whatever is at value first
 
-        val = self.eval_expression_and_get_type(node.value)
+        val = yield self.eval_expression_and_get_type(node.value)
         assert val == PyTuple, generate_error_message("val must be tuple", node)
 
         # match node.value:
@@ -404,16 +3181,23 @@ class FunctionCompiler(ast.NodeVisitor):
         #     case _:
         #         raise Exception("Trying to subscript an invalid object", node)
 
-        self.add_opcode_to_queue(Push(2))
+        if isinstance(node.slice, ast.Constant):
+            assert node.slice.value in (0, 1), generate_error_message(
+                "tuple index out of range", node
+            )
+            self.add_opcode_to_queue(Push(2 - node.slice.value))
+        else:
+            self.add_opcode_to_queue(Push(2))
 
-        subscript = self.eval_expression_and_get_type(node.slice)
-        assert subscript == ClacInt, generate_error_message(
-            "subscript must be ClacInt", node
-        )
+            subscript = yield self.eval_expression_and_get_type(node.slice)
+            assert subscript == ClacInt, generate_error_message(
+                "subscript must be ClacInt", node
+            )
+
+            # val[0] val[1] subscript
+            # TODO: statically verify that subscript is within bounds
+            self.add_opcode_to_queue(match_operator_to_BinOp(ast.Sub()))
 
-        # val[0] val[1] subscript
-        # TODO: statically verify that subscript is within bounds
-        self.add_opcode_to_queue(match_operator_to_BinOp(ast.Sub()))
         self.add_opcode_to_queue(Pick())
 
         # val[0] val[1] val[subscript]
@@ -435,6 +3219,11 @@ class FunctionCompiler(ast.NodeVisitor):
 
                 val = self.names[node.id]
                 # print(f"Loading {node.id} -> {val} @ {self.stack_size}.size")
+                if isinstance(val, ClacInt | PyTuple):
+                    self.lowest_reference = min(self.lowest_reference, val.position)
+                    if self.load_by_moving(node.id, val):
+                        return
+
                 match val:
                     case ClacInt():
                         self.add_opcode_to_queue(
@@ -458,7 +3247,7 @@ class FunctionCompiler(ast.NodeVisitor):
                 # print("Loaded:", self.queue)
             case ast.Store():
                 # raise Exception()
-                print("storing", node.id)
+                log.debug("storing %s", node.id)
             case _:
                 raise Exception()
 
@@ -473,21 +3262,57 @@ class FunctionCompiler(ast.NodeVisitor):
 
         # load args onto the stack
         # TODO: type checking
-        self.generic_visit(node)
-
-        self.add_opcode_to_queue(Call(to_call))
+        yield self.generic_visit(node)
+
+        self.add_call_to_queue(to_call)
+        for name in self.helper_reads.pop(node.func.id, ()):
+            self.loads_left[name] -= 1
+
+    def add_call_to_queue(self, to_call: ClacFunc):
+        # the arguments are already on top of the stack, exactly where the callee's code
+        # expects them, so the code of a small function can run in place of the call
+        size = token_count(to_call.code)
+        if (
+            not to_call.inlinable
+            or size > self.options.inline_threshold
+            or reaches(to_call, {to_call.name, self.function_record.name})
+        ):
+            self.add_opcode_to_queue(Call(to_call))
+            return
+
+        log.info(
+            "inline: %s into %s (%+d tokens, saves ~%d instructions per call)",
+            to_call.name,
+            self.func.name,
+            size - 1,
+            CALL_OVERHEAD,
+        )
+        for op in copy_code(to_call.code):
+            self.add_opcode_to_queue(op)
 
     def visit_Expr(self, node: ast.Expr):
-        self.generic_visit(node)
+        if self.loads_left is None:
+            yield self.generic_visit(node)
+            return
+
+        # nothing can read the result, so do not keep it around
+        match (yield self.eval_expression_and_get_type(node.value)):
+            case cls if cls is ClacInt:
+                self.add_opcode_to_queue(Drop())
+            case cls if cls is PyTuple:
+                self.add_opcode_to_queue(Drop())
+                self.add_opcode_to_queue(Drop())
 
     def visit_If(self, node: ast.If):
-        test = self.eval_expression_and_get_type(node.test)
+        test = yield self.eval_expression_and_get_type(node.test)
         assert test == ClacInt, "test must be an integer"
 
         assert len(node.body) > 0
         assert len(node.orelse) > 0
 
-        self.add_opcode_to_queue(If())
+        # the test is consumed before either arm runs
+        arm_stack_size = self.stack_size - 1
+        returns = node in self.returning
 
         # compile body
         body = ast.FunctionDef(
@@ -496,7 +3321,9 @@ class FunctionCompiler(ast.NodeVisitor):
             body=node.body,
             returns=ast.Constant(value=None),
         )
-        body_compiler = FunctionCompiler(body, self.names.copy(), self.stack_size)
+        body_compiler = FunctionCompiler(
+            body, self.names.child(), arm_stack_size, self, returns, self.options
+        )
         self.if_counter += 1
 
         # compile orelse
@@ -506,25 +3333,53 @@ class FunctionCompiler(ast.NodeVisitor):
             body=node.orelse,
             returns=ast.Constant(value=None),
         )
-        orelse_compiler = FunctionCompiler(orelse, self.names.copy(), self.stack_size)
+        orelse_compiler = FunctionCompiler(
+            orelse, self.names.child(), arm_stack_size, self, returns, self.options
+        )
         self.if_counter += 1
 
-        compiled_body = body_compiler.compile()
-        compiled_orelse = orelse_compiler.compile()
-
-        self.children_functions.append(compiled_body)
-        self.add_opcode_to_queue(Call(compiled_body))
-
-        self.add_opcode_to_queue(Push(1))
-        self.add_opcode_to_queue(Skip())
+        # the arms are compiled on the same stack of steps as we are, however deep they nest
+        compiled_body = yield body_compiler.compile_steps()
+        compiled_orelse = yield orelse_compiler.compile_steps()
 
-        self.children_functions.append(compiled_orelse)
-        self.add_opcode_to_queue(Call(compiled_orelse))
+        assert compiled_body.ret_count == compiled_orelse.ret_count, (
+            generate_error_message(
+                f"the arms of an if leave {compiled_body.ret_count} and "
+                f"{compiled_orelse.ret_count} cells on the stack",
+                node,
+            )
+        )
+        self.lowest_reference = min(
+            self.lowest_reference,
+            body_compiler.lowest_reference,
+            orelse_compiler.lowest_reference,
+        )
 
-        assert compiled_body.ret_count == compiled_orelse.ret_count
+        body_code = self.lower_arm(compiled_body)
+        orelse_code = self.lower_arm(compiled_orelse)
+        # only a returning if ends the definition, so only there is a call worth a longer layout
+        # (an outlined arm is a frame of its own, it would otherwise stay on every iteration).
+        # when both arms end in calls the one that recurses wins, then the body (loops recurse
+        # from the body)
+        name = self.function_record.name
+        else_last = ends_in_call(orelse_code) and (
+            not ends_in_call(body_code)
+            or ends_in_recursion(orelse_code, name)
+            and not ends_in_recursion(body_code, name)
+        )
+        self.add_opcode_to_queue(
+            InlineIf(
+                body_code,
+                orelse_code,
+                else_last=else_last,
+                body_last=returns and ends_in_call(body_code) and not else_last,
+            )
+        )
 
-        # TODO: implement cleaner fix for call double counting
-        self.stack_size -= compiled_body.ret_count
+        if returns:
+            # both arms already cleaned up our frame
+            self.forget_slots_above(self.return_base)
+            return
 
         ret_type: type[ClacValue]
         match compiled_body.ret_count:
@@ -536,19 +3391,54 @@ class FunctionCompiler(ast.NodeVisitor):
                 ret_type = PyTuple
             case _:
                 raise Exception()
-        self.visit_ReturnWithKnownDataAlreadyOnStack(ret_type)
+        # only what the arms left goes, the frame the if is in stays (an arm of a returning if
+        # has the enclosing function's return_base, which would take its caller's frame too)
+        self.visit_ReturnWithKnownDataAlreadyOnStack(ret_type, arm_stack_size)
+
+    def lower_arm(self, arm: ClacFunc) -> Code:
+        # small arms are emitted in place and skipped over, anything bigger is called
+        if token_count(arm.code) <= self.options.inline_if_threshold:
+            self.children_functions.extend(arm.children)
+            return arm.code
+
+        self.children_functions.append(arm)
+        if self.locations is None:
+            return Code([Call(arm)])
+        code = MappedCode()
+        code.append(Call(arm), self.locations[-1])
+        return code
 
     def visit_BinOp(self, node: ast.BinOp):
         # load all of the binop children onto the stack
         # FIXME: this could break with tuples
-        self.generic_visit(node)
+        yield self.generic_visit(node)
         self.add_opcode_to_queue(match_operator_to_BinOp(node.op))
 
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        match node:
+            case ast.UnaryOp(op=ast.UAdd()):
+                operand = yield self.eval_expression_and_get_type(node.operand)
+            case ast.UnaryOp(op=ast.USub(), operand=ast.Constant(value=int(value))):
+                self.add_opcode_to_queue(Push(clac_int(-value)))
+                return
+            case ast.UnaryOp(op=ast.USub()):
+                # there is no negate, 0 x - is one
+                self.add_opcode_to_queue(Push(0))
+                operand = yield self.eval_expression_and_get_type(node.operand)
+                self.add_opcode_to_queue(match_operator_to_BinOp(ast.Sub()))
+            case _:
+                raise Exception(
+                    generate_error_message("only - and + work as unary operators", node)
+                )
+        assert operand == ClacInt, generate_error_message(
+            "unary + and - only work on integers", node
+        )
+
     def visit_Compare(self, node: ast.Compare):
         assert len(node.ops) == 1, "can only compare one thing"
         assert len(node.comparators) == 1, "should only use one comparator"
 
-        self.generic_visit(node)
+        yield self.generic_visit(node)
         self.add_opcode_to_queue(match_operator_to_BinOp(node.ops[0]))
 
 
@@ -562,52 +3452,885 @@ class FunctionCompiler(ast.NodeVisitor):
 #     return f"__CLACC_IF_BLOCK_{id}_"
 
 
-def assemble(func: ClacFunc) -> list[list[str]]:
-    out: list[list[str]] = []
+class Deduplicator:
+    """Keeps the first definition of every body and has calls to later definitions of the same
+    body call the first one instead, across all the functions it is given. Only the output is
+    rewritten: compiled functions are inlined by later ones and pickled by the cache as they are,
+    so what they call never depends on what else happened to be in the module"""
+
+    def __init__(self):
+        # name of the definition kept for every body
+        self.kept: dict[str, str] = {}
+        # name of every definition merged away, to the name of the one kept in its place
+        self.renamed: dict[str, str] = {}
+
+    def definitions(self, func: ClacFunc) -> list[tuple[ClacFunc, str]]:
+        """The definitions of func and everything nested in it that are kept, with their lines"""
+        kept = []
+        # children first, so a body is compared with the calls into it already renamed
+        for f in nested_functions(func):
+            tokens = list(code_tokens(f.code, self.renamed))
+            name = self.kept.setdefault(" ".join(tokens), f.name)
+            # top-level functions can be called by name from outside, so they always stay
+            if name != f.name and f is not func:
+                self.renamed[f.name] = name
+                continue
+            kept.append((f, " ".join([":", f.name, *tokens, ";"])))
+        return kept
+
 
-    # assemble children
-    for i in func.children:
-        for child_function in assemble(i):
-            out.append(child_function)
+def assemble(func: ClacFunc) -> Iterator[Iterator[str]]:
+    # children are defined before the functions that call them
+    for f in nested_functions(func):
+        yield definition_tokens(f)
 
-    out.append([":", func.name] + [i.assemble() for i in func.code] + [";"])
 
-    return out
+def definition_tokens(func: ClacFunc) -> Iterator[str]:
+    yield ":"
+    yield func.name
+    yield from code_tokens(func.code)
+    yield ";"
 
 
-globally_known_functions: dict[str, ClacValue] = {
-    "print": ClacFunc("print", 1, 0, [], [])
-}
-res = [
-    ": __README This program was compiled by Stanley's cclac (Python -> Clac) compiler (github.com/stanleymw/clac) ;",
+README = ": __README This program was compiled by Stanley's cclac (Python -> Clac) compiler (github.com/stanleymw/clac) ;"
+PRELUDE = [
+    README,
     ": dup 2 pick 2 pick ;",
 ]
 
-docs = []
-res = res + docs
 
-for i in tree.body:
-    if isinstance(i, ast.FunctionDef):
-        c = FunctionCompiler(i, globally_known_functions, 0)
-        compiled = c.compile()
-        assembled = assemble(compiled)
+def module_calls(tree: ast.Module) -> list[str]:
+    """Names of the functions called by statements at module level, like `run()`"""
+    return [
+        node.func.id
+        for stmt in tree.body
+        if not isinstance(stmt, ast.FunctionDef)
+        for node in ast.walk(stmt)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+    ]
+
+
+def shake(
+    definitions: list[tuple[ClacFunc, str]],
+    entry_points: Iterable[str],
+    renamed: dict[str, str],
+) -> list[tuple[ClacFunc, str]]:
+    """The definitions (top-level functions and their arms alike) that the entry points can
+    reach through calls, in the order they were compiled"""
+    # by name rather than by object, functions loaded from the cache call copies of their callees
+    calls: dict[str, set[str]] = {}
+    for f, _ in definitions:
+        calls.setdefault(f.name, set()).update(
+            renamed.get(callee.name, callee.name) for callee in called_functions(f.code)
+        )
 
-        # print(f"Compiled: {compiled} \n Assembled: {assembled}")
-        globally_known_functions[compiled.name] = compiled
-        for i in assembled:
-            res.append(" ".join(i))
+    reached: set[str] = set()
+    worklist = list(entry_points)
+    while worklist:
+        name = worklist.pop()
+        if name in calls and name not in reached:
+            reached.add(name)
+            worklist.extend(calls[name])
+    return [(f, line) for f, line in definitions if f.name in reached]
+
+
+# longest run of instructions considered for a superinstruction
+SUPERINSTRUCTION_MAX_LENGTH = 12
+# what a superinstruction is made of: calls would stop being tail calls, and skip counts are
+# worked out from the tokens in between, so anything that jumps stays where it is
+STACK_KINDS = frozenset({OP_PUSH, OP_PICK, OP_SWAP, OP_ROT, OP_DROP, OP_BINOP})
+
+# the prelude's dup, superinstructions use it for free when the prelude is emitted
+DUP = ClacFunc("dup", 0, 2, Code([Push(2), Pick(), Push(2), Pick()]), [])
+
+
+def count_sequences(arms: list[list[Entry]]) -> dict[tuple[Entry, ...], int]:
+    """How often every run of 2 to SUPERINSTRUCTION_MAX_LENGTH stack instructions occurs in arms,
+    counting overlapping occurrences once, left to right, the way replace_sequence replaces them"""
+    counts: dict[tuple[Entry, ...], int] = {}
+    # where the last occurrence counted ends, as (arm, index)
+    ends: dict[tuple[Entry, ...], tuple[int, int]] = {}
+    for a, ops in enumerate(arms):
+        start = 0
+        while start < len(ops):
+            end = start
+            while end < len(ops) and ops[end][0] in STACK_KINDS:
+                end += 1
+            for i in range(start, end):
+                for j in range(i + 2, min(end, i + SUPERINSTRUCTION_MAX_LENGTH) + 1):
+                    key = tuple(ops[i:j])
+                    if ends.get(key, (-1, 0)) <= (a, i):
+                        counts[key] = counts.get(key, 0) + 1
+                        ends[key] = (a, j)
+            start = end + 1
+    return counts
+
+
+def replace_sequence(
+    ops: list[Entry], key: tuple[Entry, ...], call: Entry
+) -> list[Entry]:
+    replaced = []
+    i = 0
+    while i < len(ops):
+        if ops[i] == key[0] and tuple(ops[i : i + len(key)]) == key:
+            replaced.append(call)
+            i += len(key)
+        else:
+            replaced.append(ops[i])
+            i += 1
+    return replaced
+
+
+def extract_superinstructions(
+    codes: list[Code], defined: dict[tuple[Entry, ...], ClacFunc]
+) -> list[ClacFunc]:
+    """Replaces runs of stack instructions that recur across codes (and the arms in them) with
+    calls to helper words, in place. A run is only factored out while the tokens it saves
+    outweigh the calls that replace it and the helper's own definition (nothing for the words
+    in defined, which maps bodies to words that already exist). Returns the helpers to define"""
+    arms = [arm for code in codes for arm in nested_code(code)]
+    entries = [list(arm.entries()) for arm in arms]
+    defined = dict(defined)
+    helpers: list[ClacFunc] = []
+    while True:
+        best, best_saving = None, 0
+        for key, count in count_sequences(entries).items():
+            # every occurrence shrinks to a call, a new helper costs its body, name, : and ;
+            saving = count * (len(key) - 1) - (0 if key in defined else len(key) + 3)
+            if saving > best_saving:
+                best, best_saving = key, saving
+        if best is None:
+            break
+
+        if best not in defined:
+            body = Code(view(kind, operand) for kind, operand in best)
+            # calls are only ever made once code is generated, so the difference is all that matters
+            defined[best] = ClacFunc(
+                f"__W{len(helpers)}", 0, body.stack_delta(), body, []
+            )
+            helpers.append(defined[best])
+        call = (OP_CALL, Call(defined[best]))
+        entries = [replace_sequence(ops, best, call) for ops in entries]
+
+    for arm, ops in zip(arms, entries):
+        if isinstance(arm, MappedCode):
+            arm.spans = carry_spans(list(arm.entries()), arm.spans, ops)
+        arm.kinds = array("B", [kind for kind, _ in ops])
+        arm.operands = [operand for _, operand in ops]
+    return helpers
+
+
+def builtin_functions() -> dict[str, ClacValue]:
+    return {"print": ClacFunc("print", 1, 0, Code(), [], own_frame=True)}
+
+
+@functools.cache
+def compiler_digest() -> bytes:
+    # any change to the compiler itself invalidates everything it cached
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def fingerprint(node: ast.AST) -> str:
+    """Every field of node and of everything below it (but not their positions), like ast.dump
+    without recursing"""
+    parts: list[str] = []
+    # a tuple is text to add once everything pushed after it is done
+    pending: list = [node]
+    while pending:
+        match pending.pop():
+            case (str() as text,):
+                parts.append(text)
+            case ast.AST() as current:
+                parts.append(f"{type(current).__name__}(")
+                pending.append((")",))
+                for name, value in reversed(list(ast.iter_fields(current))):
+                    pending += [(";",), value, (f"{name}=",)]
+            case list() as values:
+                parts.append("[")
+                pending.append(("]",))
+                for value in reversed(values):
+                    pending += [(",",), value]
+            case value:
+                parts.append(repr(value))
+    return "".join(parts)
+
+
+def called_names(func: ast.FunctionDef) -> set[str]:
+    return {
+        node.func.id
+        for node in ast.walk(func)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+    }
+
+
+@dataclass
+class ModuleSnapshot:
+    # every top-level function as it was parsed (see fingerprint), folding rewrites them in place
+    sources: dict[str, str]
+    calls: dict[str, set[str]]
+
+    @staticmethod
+    def of(tree: ast.Module) -> "ModuleSnapshot":
+        functions = [stmt for stmt in tree.body if isinstance(stmt, ast.FunctionDef)]
+        return ModuleSnapshot(
+            {func.name: fingerprint(func) for func in functions},
+            {func.name: called_names(func) for func in functions},
+        )
 
 
-final = "\n".join(res)
+def move_lines(func: ClacFunc, moved: int):
+    """Shifts every line func (and everything nested in it) says it came from by moved"""
+    if not moved:
+        return
+    for f in nested_functions(func):
+        if f.origin is not None:
+            f.origin = (f.origin[0], f.origin[1] + moved)
+        for arm in nested_code(f.code):
+            if isinstance(arm, MappedCode):
+                arm.spans = [span and (span[0] + moved, span[1]) for span in arm.spans]
+
+
+class FunctionCache:
+    """Compiled top-level functions on disk, keyed by everything their output depends on.
+    Holds at most max_entries, evicting the least recently used ones"""
+
+    def __init__(self, directory: str, max_entries: int = 4096):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(
+        self,
+        func: ast.FunctionDef,
+        module: "ModuleSnapshot",
+        known: dict[str, ClacValue],
+        keys: dict[str, str],
+        options: CompilerOptions,
+    ) -> str:
+        digest = hashlib.sha256(compiler_digest())
+        digest.update(repr(options).encode())
+        digest.update(fingerprint(func).encode())
+
+        # constant evaluation can run any module function reachable from this one,
+        # whether or not it has been compiled yet
+        reachable: set[str] = set()
+        worklist = list(called_names(func))
+        while worklist:
+            name = worklist.pop()
+            if name in module.sources and name not in reachable:
+                reachable.add(name)
+                worklist.extend(module.calls[name])
+        for name in sorted(reachable):
+            digest.update(module.sources[name].encode())
+
+        # calls can inline the callee, so what matters is how it was compiled, not just its signature
+        referenced = {n.id for n in ast.walk(func) if isinstance(n, ast.Name)}
+        for name in sorted(referenced & known.keys()):
+            digest.update(f"{name}={keys.get(name) or known[name]!r};".encode())
+
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def load(self, key: str) -> tuple[ClacFunc, list[str]] | None:
+        try:
+            with open(self.path(key), "rb") as f:
+                entry = pickle.load(f)
+            # the modification time doubles as the last time an entry was used
+            os.utime(self.path(key))
+        except OSError:
+            # missing, or evicted by another process
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            # cut short, which writing entries whole and renaming them should rule out
+            log.warning("cache: ignoring unreadable entry %s", key)
+            return None
+        except AttributeError:
+            # pickled by new.py running as a script rather than a module, or by a version
+            # of it whose classes were named differently
+            return None
+        return entry
+
+    def store(self, key: str, func: ClacFunc, lines: list[str]):
+        # write and rename, so other processes sharing the directory never see half an entry
+        temp = f"{self.path(key)}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "wb") as f:
+                pickle.dump((func, lines), f)
+            os.replace(temp, self.path(key))
+        except RecursionError:
+            # pickle recurses into every nested arm, such a function is just compiled again next time
+            return
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+        self.evict()
+
+    def evict(self):
+        entries = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".pickle")
+        ]
+        if len(entries) <= self.max_entries:
+            return
+
+        def last_used(entry: os.DirEntry) -> float:
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0.0
+
+        entries.sort(key=last_used)
+        for entry in entries[: len(entries) - self.max_entries]:
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+
+
+class PassTimer:
+    """Wall time and peak memory of every pass it times, for --time-passes. Memory is traced
+    with tracemalloc from the moment a timer is made, which slows everything down a bit"""
+
+    def __init__(self):
+        # (pass, what it ran on, seconds, most bytes it had allocated at once)
+        self.passes: list[tuple[str, str, float, int]] = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, name: str, subject: str = "") -> Iterator[None]:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = max(tracemalloc.get_traced_memory()[1] - base, 0)
+            self.passes.append((name, subject, elapsed, peak))
+
+    def report(self) -> str:
+        """Every pass in the order they ran, then the total time and largest peak of each pass"""
+        rows = [("pass", "of", "ms", "peak KiB")]
+        totals: dict[str, tuple[float, int, int]] = {}
+        for name, subject, elapsed, peak in self.passes:
+            rows.append((name, subject, f"{elapsed * 1000:.2f}", f"{peak / 1024:.1f}"))
+            seconds, largest, runs = totals.get(name, (0.0, 0, 0))
+            totals[name] = (seconds + elapsed, max(largest, peak), runs + 1)
+        rows.append(("", "", "", ""))
+        for name, (seconds, largest, runs) in totals.items():
+            rows.append(
+                (
+                    name,
+                    f"total of {runs}",
+                    f"{seconds * 1000:.2f}",
+                    f"{largest / 1024:.1f}",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(width) if i < 2 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            ).rstrip()
+            for row in rows
+        )
 
-# print(final)
 
-# cv = ClacCompile(0, "")
-# compiled = cv.compile(tree)
-# if_blocks += "\n"
-# res = preamble + "\n".join([i for i in if_blocks]) + compiled
-# print(res)
-# print([(i,v.value) for (i,v) in cv.variables.items()])
-# print("Stack pos:", cv.current_stack_position)
-with open("out.clac", "w") as w:
-    w.write(final)
+def timed(
+    timer: PassTimer | None, name: str, subject: str = ""
+) -> contextlib.AbstractContextManager:
+    return contextlib.nullcontext() if timer is None else timer.measure(name, subject)
+
+
+def compile_source(
+    src: str, options: CompilerOptions | None = None, cache: FunctionCache | None = None
+) -> str:
+    """Compiles a python program to clac, every call starts from a clean slate
+    (apart from functions it finds in cache)"""
+    return compile_module(ast.parse(src), options, cache)
+
+
+def compile_module(
+    tree: ast.Module,
+    options: CompilerOptions | None = None,
+    cache: FunctionCache | None = None,
+) -> str:
+    """compile_source for a program that is already parsed. Python's parser gives up on source
+    nested a few thousand blocks deep, the compiler does not, so trees can also be built directly"""
+    out = io.StringIO()
+    write_module(tree, out, options, cache)
+    return out.getvalue()
+
+
+def write_source(
+    src: str,
+    out: TextIO,
+    options: CompilerOptions | None = None,
+    cache: FunctionCache | None = None,
+    stack_effects: list[StackEffect] | None = None,
+    origins: dict[str, tuple[str, int]] | None = None,
+    source_map: dict[str, list[Span | None]] | None = None,
+    timer: PassTimer | None = None,
+):
+    """compile_source, writing the program to out as it goes instead of returning it"""
+    with timed(timer, "parse"):
+        tree = ast.parse(src)
+    write_module(tree, out, options, cache, stack_effects, origins, source_map, timer)
+
+
+class LineWriter:
+    # lines are separated, not terminated, the same as joining them with newlines
+    def __init__(self, out: TextIO):
+        self.out = out
+        self.separator = ""
+
+    def write(self, line: str):
+        self.out.write(self.separator)
+        self.out.write(line)
+        self.separator = "\n"
+
+
+def write_module(
+    tree: ast.Module,
+    out: TextIO,
+    options: CompilerOptions | None = None,
+    cache: FunctionCache | None = None,
+    stack_effects: list[StackEffect] | None = None,
+    origins: dict[str, tuple[str, int]] | None = None,
+    source_map: dict[str, list[Span | None]] | None = None,
+    timer: PassTimer | None = None,
+):
+    """compile_module, writing every definition to out as soon as the top-level function it
+    belongs to is compiled, so only one function's worth of output is ever held in memory.
+    Shaking has to wait for the whole module, since later functions decide what earlier ones keep.
+    Given stack_effects, every definition is verified and its StackEffect added to it, given
+    origins, the origin of every definition written is added to it by name. Given source_map,
+    the span of every token in the body of every definition written is, for the ones that
+    came from the source at all. Given timer, every pass is timed with it"""
+    options = options or CompilerOptions()
+    if source_map is not None:
+        options = dataclasses.replace(options, source_map=True)
+    # shaking from nothing would drop every definition, so say so before writing any
+    if options.shake and not (options.entry_points or module_calls(tree)):
+        raise Exception(
+            "nothing to shake from: the module calls no function at top level, "
+            "name the entry points with --entry"
+        )
+    globally_known_functions = builtin_functions()
+    writer = LineWriter(out)
+    # nothing the compiler generates calls into the prelude
+    for line in [README] if options.shake else PRELUDE:
+        writer.write(line)
+    dedup = Deduplicator() if options.dedup else None
+    # shaking and superinstructions look at the whole module, so they hold definitions back
+    deferred = options.shake or options.superinstructions
+    definitions: list[tuple[ClacFunc, str]] = []
+
+    # names of the shared words defined so far
+    shared: set[str] = set()
+    verifier = StackVerifier() if stack_effects is not None else None
+
+    def write(func: ClacFunc, line: str, code: Code):
+        writer.write(line)
+        if source_map is not None and any(spans := list(code_spans(code))):
+            source_map[func.name] = spans
+
+    def emit(compiled: ClacFunc, lines: Iterable[str]):
+        if verifier is not None:
+            with timed(timer, "verify", compiled.name):
+                stack_effects.extend(verifier.verify(compiled))
+        with timed(timer, "assemble", compiled.name):
+            assemble_definitions(compiled, lines)
+
+    def assemble_definitions(compiled: ClacFunc, lines: Iterable[str]):
+        # shared words go right before the first function that calls them (or inlined a call)
+        words = []
+        for f in nested_functions(compiled):
+            for callee in called_functions(f.code):
+                if callee.shared and callee.name not in shared:
+                    shared.add(callee.name)
+                    line = " ".join([":", callee.name, *code_tokens(callee.code), ";"])
+                    words.append((callee, line))
+
+        if dedup is None:
+            kept = zip(nested_functions(compiled), lines)
+        else:
+            kept = dedup.definitions(compiled)
+            if merged := len(nested_functions(compiled)) - len(kept):
+                log.info("dedup: merged %d definitions of %s", merged, compiled.name)
+        kept = itertools.chain(words, kept)
+        if origins is not None:
+            kept = list(kept)
+            origins.update((f.name, f.origin) for f, _ in kept if f.origin)
+        if deferred:
+            definitions.extend(kept)
+            return
+        for f, line in kept:
+            write(f, line, f.code)
+
+    pure_functions = PureFunctions(tree) if options.const_eval else None
+    # loops that leave a value for what follows them return it, typed after these
+    returns = {f.name: f.returns for f in tree.body if isinstance(f, ast.FunctionDef)}
+
+    module = ModuleSnapshot.of(tree) if cache is not None else None
+    # cache key of every function compiled so far
+    keys: dict[str, str] = {}
+
+    for i in tree.body:
+        if isinstance(i, ast.FunctionDef):
+            if cache is not None:
+                key = cache.key(i, module, globally_known_functions, keys, options)
+                with timed(timer, "cache", i.name):
+                    entry = cache.load(key)
+                if entry is not None:
+                    compiled, lines = entry
+                    # keys leave out positions, so the function may have moved since
+                    if compiled.origin is not None:
+                        move_lines(compiled, i.lineno - compiled.origin[1])
+                    globally_known_functions[compiled.name] = compiled
+                    keys[compiled.name] = key
+                    emit(compiled, lines)
+                    continue
+
+            with timed(timer, "loops", i.name):
+                i = lower_loops(i, returns, options)
+            if options.fold:
+                with timed(timer, "fold", i.name):
+                    i = fold_function(i, pure_functions)
+            with timed(timer, "codegen", i.name):
+                c = FunctionCompiler(
+                    i, Scope(local=globally_known_functions).child(), 0, options=options
+                )
+                compiled = c.compile()
+            if options.schedule:
+                with timed(timer, "schedule", i.name):
+                    scheduled = schedule_function(compiled)
+                for name, removed in scheduled.items():
+                    if removed:
+                        log.info(
+                            "schedule: removed %d instructions from %s", removed, name
+                        )
+            with timed(timer, "peephole", i.name):
+                optimized = optimize(compiled, options.rules())
+            for name, removed in optimized.items():
+                if removed:
+                    log.info("peephole: removed %d instructions from %s", removed, name)
+            if options.cleanup_words:
+                with timed(timer, "cleanup", i.name):
+                    cleaned = call_cleanups_function(compiled)
+                for name, saved in cleaned.items():
+                    if saved:
+                        log.info("cleanup: saved %d tokens in %s", saved, name)
+            lines = (" ".join(definition) for definition in assemble(compiled))
+            if cache is not None:
+                with timed(timer, "assemble", compiled.name):
+                    lines = list(lines)
+            emit(compiled, lines)
+
+            globally_known_functions[compiled.name] = compiled
+            if cache is not None:
+                with timed(timer, "cache", compiled.name):
+                    cache.store(key, compiled, lines)
+                keys[compiled.name] = key
+
+    if not deferred:
+        return
+    renamed = dedup.renamed if dedup else {}
+    if options.shake:
+        entry_points = options.entry_points or module_calls(tree)
+        for name in options.entry_points:
+            if not isinstance(globally_known_functions.get(name), ClacFunc):
+                raise Exception(f"entry point {name} is not a function")
+        with timed(timer, "shake"):
+            kept = shake(definitions, entry_points, renamed)
+        log.info(
+            "shake: dropped %d of %d definitions",
+            len(definitions) - len(kept),
+            len(definitions),
+        )
+        definitions = kept
+
+    codes = [f.code for f, _ in definitions]
+    helpers: list[ClacFunc] = []
+    if options.superinstructions:
+        # on copies, the compiled functions are still inlined and cached as they are
+        with timed(timer, "superinstructions"):
+            codes = [copy_code(code) for code in codes]
+            prelude = {} if options.shake else {tuple(DUP.code.entries()): DUP}
+            helpers = extract_superinstructions(codes, prelude)
+        log.info("superinstructions: factored out %d words", len(helpers))
+
+    with timed(timer, "assemble"):
+        for word in helpers:
+            writer.write(" ".join([":", word.name, *code_tokens(word.code), ";"]))
+        if options.superinstructions:
+            definitions = [
+                (f, " ".join([":", f.name, *code_tokens(code, renamed), ";"]))
+                for (f, _), code in zip(definitions, codes)
+            ]
+        for (f, line), code in zip(definitions, codes):
+            write(f, line, code)
+
+
+def compile_file(
+    path: str, options: CompilerOptions, cache: FunctionCache | None = None
+) -> str | None:
+    """Compiles path into a .clac file next to it, returns why it failed if it did"""
+    try:
+        with open(path, "r") as f:
+            src = f.read()
+        final = compile_source(src, options, cache)
+    except Exception as e:
+        # the compiler reports what it cannot compile as plain exceptions, so any of them
+        # is this file's error (with -vv the traceback goes with it)
+        log.debug("compiling %s failed", path, exc_info=True)
+        return f"{type(e).__name__}: {e}"
+
+    with open(os.path.splitext(path)[0] + ".clac", "w") as w:
+        w.write(final)
+    return None
+
+
+def compile_directory(
+    directory: str,
+    options: CompilerOptions,
+    jobs: int | None = None,
+    cache: FunctionCache | None = None,
+) -> dict[str, str | None]:
+    """Compiles every python file under directory across a process pool, returns the error (if any) per file"""
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.endswith(".py")
+    )
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        errors = pool.map(
+            compile_file,
+            paths,
+            [options] * len(paths),
+            [cache] * len(paths),
+            chunksize=max(1, len(paths) // (4 * (jobs or os.cpu_count() or 1))),
+        )
+        return dict(zip(paths, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compiles a subset of Python to Clac")
+    parser.add_argument(
+        "file", help="python source file to compile (a directory of them with --batch)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="out.clac",
+        help="where to write the compiled program, - for stdout (default: out.clac)",
+    )
+    parser.add_argument(
+        "--no-peephole", action="store_true", help="disable the peephole optimizer"
+    )
+    parser.add_argument(
+        "--disable-rule",
+        action="append",
+        default=[],
+        metavar="RULE",
+        choices=[rule.name for rule in PEEPHOLE_RULES],
+        help="disable a single peephole rule (can be repeated)",
+    )
+    parser.add_argument(
+        "--inline-if-threshold",
+        type=int,
+        default=CompilerOptions.inline_if_threshold,
+        metavar="TOKENS",
+        help="inline if-arms that assemble to at most this many tokens (0 outlines every arm)",
+    )
+    parser.add_argument(
+        "--no-fold", action="store_true", help="disable constant folding"
+    )
+    parser.add_argument(
+        "--no-const-eval",
+        action="store_true",
+        help="never evaluate calls to pure functions at compile time",
+    )
+    parser.add_argument(
+        "--inline-threshold",
+        type=int,
+        default=CompilerOptions.inline_threshold,
+        metavar="TOKENS",
+        help="inline calls to functions that assemble to at most this many tokens (0 disables inlining)",
+    )
+    parser.add_argument(
+        "--unroll-limit",
+        type=int,
+        default=CompilerOptions.unroll_limit,
+        metavar="TRIPS",
+        help="unroll range loops that run a constant number of times, at most this many (0 never unrolls)",
+    )
+    parser.add_argument(
+        "--no-liveness",
+        action="store_true",
+        help="keep every local on the stack until the function returns",
+    )
+    parser.add_argument(
+        "--no-schedule",
+        action="store_true",
+        help="keep the stack moves the code generator emitted instead of re-deriving them",
+    )
+    parser.add_argument(
+        "--no-tail-calls",
+        action="store_true",
+        help="always clean up the frame after a returned call instead of before it",
+    )
+    parser.add_argument(
+        "--cleanup-words",
+        action="store_true",
+        help="call shared words for long frame cleanups instead of spelling them out",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="emit every definition, even when an earlier one has the same body",
+    )
+    parser.add_argument(
+        "--superinstructions",
+        action="store_true",
+        help="factor recurring runs of stack instructions out into shared helper words",
+    )
+    parser.add_argument(
+        "--shake",
+        action="store_true",
+        help="drop definitions that nothing called at module level can reach",
+    )
+    parser.add_argument(
+        "--entry",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="shake from this function instead of the module-level calls (can be repeated)",
+    )
+    parser.add_argument(
+        "--stack-report",
+        metavar="PATH",
+        help="verify the stack effect of every definition and write them to PATH as JSON, "
+        "failing if any is wrong",
+    )
+    parser.add_argument(
+        "--source-map",
+        metavar="PATH",
+        help="write the python line and column of every token in every definition to PATH as JSON",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="say what the passes did, twice to also trace the code generator",
+    )
+    parser.add_argument(
+        "--time-passes",
+        action="store_true",
+        help="report the wall time and peak memory of every pass on stderr",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="compile every .py file under the given directory, writing each output next to its input",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="worker processes for --batch (default: one per core)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="reuse functions compiled by earlier runs, keeping them in DIR",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4096,
+        metavar="N",
+        help="keep at most N functions in the cache, dropping the least recently used",
+    )
+    cli = parser.parse_args()
+    # traces go to stderr, which keeps stdout for the program with -o -
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(cli.verbose, 2)],
+        format="%(message)s",
+        stream=sys.stderr,
+    )
+
+    cache = FunctionCache(cli.cache_dir, cli.cache_size) if cli.cache_dir else None
+    options = CompilerOptions(
+        peephole_rules=()
+        if cli.no_peephole
+        else tuple(
+            rule.name for rule in PEEPHOLE_RULES if rule.name not in cli.disable_rule
+        ),
+        inline_if_threshold=cli.inline_if_threshold,
+        inline_threshold=cli.inline_threshold,
+        unroll_limit=cli.unroll_limit,
+        fold=not cli.no_fold,
+        const_eval=not cli.no_const_eval,
+        liveness=not cli.no_liveness,
+        schedule=not cli.no_schedule,
+        tail_calls=not cli.no_tail_calls,
+        cleanup_words=cli.cleanup_words,
+        dedup=not cli.no_dedup,
+        superinstructions=cli.superinstructions,
+        shake=cli.shake or bool(cli.entry),
+        entry_points=tuple(cli.entry),
+    )
+
+    if cli.batch:
+        results = compile_directory(cli.file, options, cli.jobs, cache)
+        failed = {path: error for path, error in results.items() if error}
+        for path, error in failed.items():
+            print(f"{path}: {error}", file=sys.stderr)
+        print(f"compiled {len(results) - len(failed)} of {len(results)} programs")
+        sys.exit(1 if failed else 0)
+
+    log.info("Seirea CLAC Compiler v0.1.0")
+    with open(cli.file, "r") as f:
+        src = f.read()
+    if log.isEnabledFor(logging.DEBUG):
+        with contextlib.suppress(RecursionError):
+            # too deeply nested to print is not too deeply nested to compile
+            log.debug("%s", ast.dump(ast.parse(src), indent=4))
+
+    stack_effects = [] if cli.stack_report else None
+    source_map = {} if cli.source_map else None
+    timer = PassTimer() if cli.time_passes else None
+    if cli.output == "-":
+        write_source(
+            src, sys.stdout, options, cache, stack_effects, None, source_map, timer
+        )
+    else:
+        with open(cli.output, "w") as w:
+            write_source(src, w, options, cache, stack_effects, None, source_map, timer)
+
+    if timer is not None:
+        print(timer.report(), file=sys.stderr)
+
+    if source_map is not None:
+        with open(cli.source_map, "w") as f:
+            # tokens are counted from the first one after the name of the definition
+            json.dump({"source": cli.file, "words": source_map}, f)
+
+    if stack_effects is not None:
+        with open(cli.stack_report, "w") as f:
+            json.dump([dataclasses.asdict(e) for e in stack_effects], f, indent=2)
+        wrong = [e for e in stack_effects if e.errors]
+        for effect in wrong:
+            for error in effect.errors:
+                print(f"{effect.name}: {error}", file=sys.stderr)
+        sys.exit(1 if wrong else 0)
+
+
+if __name__ == "__main__":
+    main()